@@ -1,38 +1,101 @@
 from django.contrib import admin
-
-from recipes.models import User, Ingredient, Tag, Recipe
-
-
-class UserAdmin(admin.ModelAdmin):
-    list_display = ('id', 'email', 'username', 'first_name', 'last_name')
-    list_filter = ('email', 'username')
-    search_fields = ('username', 'email')
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+from recipes.models import User, Ingredient, IngredientInRecipe, Tag, Recipe
+
+
+class EstimatedCountPaginator(Paginator):
+    # Точный COUNT(*) по большой таблице читает её целиком, поэтому
+    # для списка без фильтров берём оценку из статистики PostgreSQL.
+    estimate_threshold = 100000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql' and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT reltuples FROM pg_class WHERE relname = %s',
+                    [queryset.model._meta.db_table]
+                )
+                row = cursor.fetchone()
+            if row and row[0] >= self.estimate_threshold:
+                return int(row[0])
+        return super().count
+
+
+class ScalableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        # Ищем по префиксу всей строки, а не по отдельным словам:
+        # так каждое условие попадает в индекс.
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        condition = Q()
+        for field in self.get_search_fields(request):
+            condition |= Q(**{field: search_term})
+        return queryset.filter(condition), False
+
+
+class UserAdmin(ScalableAdmin):
+    list_display = ('id', 'email', 'username', 'first_name', 'last_name',
+                    'recipes_count', 'subscribers_count')
+    list_filter = ('is_staff', 'is_active')
+    search_fields = ('username__istartswith', 'email__exact')
+    ordering = ('username',)
 
 
 admin.site.register(User, UserAdmin)
 
 
-class IngredientAdmin(admin.ModelAdmin):
+class IngredientAdmin(ScalableAdmin):
     list_display = ('name', 'measurement_unit',)
-    search_fields = ('name',)
+    search_fields = ('name__istartswith',)
 
 
 admin.site.register(Ingredient, IngredientAdmin)
 
 
-class TagAdmin(admin.ModelAdmin):
-    list_display = ('name', 'color')
-    search_fields = ('name', 'author__username')
+class TagAdmin(ScalableAdmin):
+    list_display = ('name', 'color', 'slug')
+    search_fields = ('name__istartswith', 'slug__exact')
 
 
 admin.site.register(Tag, TagAdmin)
 
 
-class RecipeAdmin(admin.ModelAdmin):
-    list_display = ('name', 'text', 'cooking_time',
-                    'author', 'pub_date',)
-    list_filter = ('author', 'name', 'tags')
-    search_fields = ('name', 'author__username')
+class IngredientInRecipeInline(admin.TabularInline):
+    model = IngredientInRecipe
+    raw_id_fields = ('ingredient',)
+    extra = 0
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related(
+            'ingredient', 'recipe'
+        )
+
+
+class RecipeAdmin(ScalableAdmin):
+    list_display = ('name', 'cooking_time', 'author', 'pub_date',
+                    'favorites_count', 'carts_count')
+    list_select_related = ('author',)
+    list_filter = ('tags',)
+    search_fields = ('name__istartswith', 'author__username__exact')
+    autocomplete_fields = ('author', 'tags')
+    inlines = (IngredientInRecipeInline,)
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if request.resolver_match.url_name.endswith('changelist'):
+            queryset = queryset.defer('text')
+        return queryset
 
 
 admin.site.register(Recipe, RecipeAdmin)
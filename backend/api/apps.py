@@ -1,5 +1,14 @@
 from django.apps import AppConfig
+from django.core.signals import request_finished
+from django.db.backends.signals import connection_created
 
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        from . import feed_cache, metrics, slow_queries
+        connection_created.connect(metrics.install)
+        connection_created.connect(slow_queries.install)
+        request_finished.connect(slow_queries.flush_on_request_finished)
+        request_finished.connect(feed_cache.flush_on_request_finished)
@@ -0,0 +1,40 @@
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from rest_framework.permissions import SAFE_METHODS
+
+
+def run_in_thread_pool(view):
+    # DRF не умеет асинхронные вьюхи, поэтому под ASGI выполняем чтение
+    # целиком в пуле потоков и не держим событийный цикл на ORM. Запись
+    # идёт, как у любой синхронной вьюхи, в общем потоке Django.
+    def run(request, *args, **kwargs):
+        try:
+            response = view(request, *args, **kwargs)
+            if callable(getattr(response, 'render', None)):
+                response.render()
+            return response
+        finally:
+            close_old_connections()
+
+    read = sync_to_async(run, thread_sensitive=False)
+    write = sync_to_async(view, thread_sensitive=True)
+
+    @wraps(view)
+    async def async_view(request, *args, **kwargs):
+        if request.method in SAFE_METHODS:
+            return await read(request, *args, **kwargs)
+        return await write(request, *args, **kwargs)
+
+    return async_view
+
+
+class AsyncReadMixin:
+    @classmethod
+    def as_view(cls, actions=None, **initkwargs):
+        view = super().as_view(actions, **initkwargs)
+        if not settings.ASYNC_READ_VIEWS:
+            return view
+        return run_in_thread_pool(view)
@@ -0,0 +1,88 @@
+import atexit
+import hashlib
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.http import urlencode
+
+from recipes.versions import get_version
+
+STATS_KEYS = {
+    'hits': 'recipes-feed:hits',
+    'misses': 'recipes-feed:misses',
+}
+
+
+def feed_cache_key(request):
+    params = sorted(
+        (key, sorted(request.query_params.getlist(key)))
+        for key in request.query_params
+    )
+    digest = hashlib.md5(
+        f'{request.scheme}://{request.get_host()}?'
+        f'{urlencode(params, doseq=True)}'.encode()
+    ).hexdigest()
+    return f'recipes-feed:{get_version("recipes")}:{digest}'
+
+
+def get_cached_feed(key):
+    body = cache.get(key)
+    stats.record('misses' if body is None else 'hits')
+    return body
+
+
+def cache_feed(key, body):
+    cache.set(key, body, timeout=settings.RECIPE_FEED_CACHE_TIMEOUT)
+
+
+class FeedCacheStats:
+    # Попадания считаем в памяти процесса и сливаем в кэш раз в
+    # RECIPE_FEED_STATS_INTERVAL секунд: incr на каждый запрос стоил бы
+    # записи на диск у FileBasedCache и терял бы значения в гонке.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._flushed = time.monotonic()
+
+    def record(self, name):
+        with self._lock:
+            self._counts[name] += 1
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        interval = settings.RECIPE_FEED_STATS_INTERVAL
+        if self._counts and time.monotonic() - self._flushed >= interval:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+            self._flushed = time.monotonic()
+        for name, count in counts.items():
+            try:
+                cache.incr(STATS_KEYS[name], count)
+            except ValueError:
+                cache.add(STATS_KEYS[name], 0, timeout=None)
+                cache.incr(STATS_KEYS[name], count)
+
+
+stats = FeedCacheStats()
+
+
+def flush_on_request_finished(sender, **kwargs):
+    stats.maybe_flush()
+
+
+atexit.register(stats.flush)
+
+
+def feed_cache_stats():
+    stats.flush()
+    values = cache.get_many(STATS_KEYS.values())
+    return {
+        name: values.get(key, 0) for name, key in STATS_KEYS.items()
+    }
@@ -1,6 +1,7 @@
 from django_filters.rest_framework import FilterSet, filters
 
 from recipes.models import Recipe, Tag, User
+from recipes.search import search_recipes
 
 
 class RecipeFilter(FilterSet):
@@ -20,6 +21,9 @@ class RecipeFilter(FilterSet):
         to_field_name='id',
         queryset=User.objects.all()
     )
+    search = filters.CharFilter(
+        method='get_search'
+    )
 
     class Meta:
         model = Recipe
@@ -28,6 +32,7 @@ class RecipeFilter(FilterSet):
             'is_in_shopping_cart',
             'tags',
             'author',
+            'search',
         )
 
     def get_is_favorited(self, queryset, name, value):
@@ -39,3 +44,6 @@ class RecipeFilter(FilterSet):
         if value:
             return queryset.filter(cart__user=self.request.user)
         return queryset
+
+    def get_search(self, queryset, name, value):
+        return search_recipes(queryset, value)
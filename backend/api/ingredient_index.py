@@ -0,0 +1,51 @@
+import threading
+from bisect import bisect_left
+
+from recipes.models import Ingredient
+from recipes.versions import get_version
+
+
+def normalize(value):
+    return value.lower().replace('ё', 'е')
+
+
+class IngredientIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = (None, [], [])
+
+    def _build(self, version):
+        rows = sorted(
+            (normalize(name), pk, name, measurement_unit)
+            for pk, name, measurement_unit in Ingredient.objects.values_list(
+                'id', 'name', 'measurement_unit'
+            )
+        )
+        self._state = (
+            version,
+            [row[0] for row in rows],
+            [
+                {'id': pk, 'name': name, 'measurement_unit': unit}
+                for _, pk, name, unit in rows
+            ],
+        )
+
+    def _current(self):
+        version = get_version('ingredients')
+        if self._state[0] != version:
+            with self._lock:
+                if self._state[0] != version:
+                    self._build(version)
+        return self._state
+
+    def search(self, prefix=''):
+        _, keys, rows = self._current()
+        prefix = normalize(prefix)
+        if not prefix:
+            return rows
+        return rows[
+            bisect_left(keys, prefix):bisect_left(keys, prefix + '\uffff')
+        ]
+
+
+ingredient_index = IngredientIndex()
@@ -0,0 +1,397 @@
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (
+    CaptureQueriesContext,
+    setup_test_environment,
+    teardown_test_environment
+)
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+
+from api.recipe_reader import build_recipes, recipe_values
+from api.renderers import FastJSONRenderer
+from api.serializers import RecipeReadSerializer
+from api.views import RecipeViewSet
+
+from recipes.models import (
+    Favorite,
+    FeedItem,
+    Ingredient,
+    IngredientInRecipe,
+    Recipe,
+    ShoppingCart,
+    Subscription,
+    Tag
+)
+from recipes.counters import recount
+from recipes.following import rebuild as rebuild_following_feeds
+from recipes.search import search_recipes, update_search_index
+from recipes.versions import bump_version
+
+User = get_user_model()
+
+# Бюджеты сценариев: (максимум SQL-запросов, максимум p95 в мс).
+BUDGETS = {
+    'recipes-list-anonymous': (5, 150),
+    'recipes-list-cached': (0, 20),
+    'recipes-list-authenticated': (7, 150),
+    'recipes-list-cursor': (4, 150),
+    'recipes-list-tags': (8, 150),
+    'recipes-list-author': (8, 150),
+    'recipes-list-is-favorited': (7, 150),
+    'recipes-search': (7, 150),
+    'recipes-following-feed': (7, 150),
+    'recipes-retrieve-anonymous': (4, 50),
+    'recipes-retrieve-authenticated': (6, 50),
+    'users-list': (3, 100),
+    'users-subscriptions': (5, 150),
+    'download-shopping-cart': (2, 150),
+    'ingredients-search': (0, 20),
+}
+
+# Сценарии, которые меряют попадание в кэш ленты. Перед остальными кэш
+# сбрасывается, чтобы бюджеты стерегли настоящий путь до базы.
+CACHED_SCENARIOS = ('recipes-list-cached',)
+
+# Таблицы, которые горячие запросы должны читать только по индексам.
+INDEXED_TABLES = (
+    Recipe._meta.db_table,
+    Ingredient._meta.db_table,
+    Favorite._meta.db_table,
+    ShoppingCart._meta.db_table,
+    FeedItem._meta.db_table,
+)
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    index = round(percent / 100 * (len(ordered) - 1))
+    return ordered[index]
+
+
+def response_size(response):
+    if response.streaming:
+        return sum(len(chunk) for chunk in response.streaming_content)
+    return len(response.content)
+
+
+class Command(BaseCommand):
+    help = (
+        'Заполняет тестовую базу данными и прогоняет горячие эндпоинты API, '
+        'проверяя количество SQL-запросов и задержку.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--recipes', type=int, default=300)
+        parser.add_argument('--ingredients', type=int, default=500)
+        parser.add_argument('--ingredients-per-recipe', type=int, default=8)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument(
+            '--no-latency',
+            action='store_true',
+            help='Не проверять бюджет задержки, только число запросов.'
+        )
+        parser.add_argument(
+            '--explain',
+            action='store_true',
+            help='Проверить планы горячих запросов на Seq Scan (PostgreSQL).'
+        )
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False
+        )
+        try:
+            fixtures = self.prepare(options)
+            results = self.run_scenarios(fixtures, options['repeat'])
+            self.report_read_path(fixtures, options['repeat'])
+            failures = []
+            if options['explain']:
+                failures = self.check_query_plans(fixtures)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+        self.report(
+            results,
+            check_latency=not options['no_latency'],
+            failures=failures
+        )
+
+    def prepare(self, options):
+        fixtures = self.seed(options)
+        # bulk_create не шлёт сигналы, поэтому пересчитываем счётчики
+        # и сбрасываем кэши вручную.
+        recount()
+        update_search_index()
+        rebuild_following_feeds()
+        for version in ('recipes', 'ingredients', 'tags'):
+            bump_version(version)
+        return fixtures
+
+    def seed(self, options):
+        rnd = random.Random(0)
+        User.objects.bulk_create(
+            User(
+                email=f'bench{number}@example.com',
+                username=f'bench{number}',
+                first_name=f'Имя{number}',
+                last_name=f'Фамилия{number}',
+            ) for number in range(options['users'])
+        )
+        users = list(User.objects.order_by('id'))
+        Tag.objects.bulk_create(
+            Tag(name=f'Тэг {number}', color=f'#00000{number}',
+                slug=f'tag-{number}')
+            for number in range(3)
+        )
+        tags = list(Tag.objects.order_by('id'))
+        Ingredient.objects.bulk_create(
+            Ingredient(name=f'ингредиент {number}', measurement_unit='г')
+            for number in range(options['ingredients'])
+        )
+        ingredients = list(Ingredient.objects.values_list('id', flat=True))
+        Recipe.objects.bulk_create(
+            Recipe(
+                name=f'Рецепт {number}',
+                text='Описание рецепта. ' * 20,
+                cooking_time=rnd.randint(1, 120),
+                author=rnd.choice(users),
+            ) for number in range(options['recipes'])
+        )
+        recipes = list(Recipe.objects.values_list('id', flat=True))
+        IngredientInRecipe.objects.bulk_create(
+            IngredientInRecipe(
+                recipe_id=recipe,
+                ingredient_id=ingredient,
+                amount=rnd.randint(1, 500),
+            )
+            for recipe in recipes
+            for ingredient in rnd.sample(
+                ingredients, options['ingredients_per_recipe']
+            )
+        )
+        Recipe.tags.through.objects.bulk_create(
+            Recipe.tags.through(recipe_id=recipe, tag_id=tag.id)
+            for recipe in recipes
+            for tag in rnd.sample(tags, 2)
+        )
+        reader = users[0]
+        Subscription.objects.bulk_create(
+            Subscription(user=reader, author=author) for author in users[1:]
+        )
+        Favorite.objects.bulk_create(
+            Favorite(user=reader, recipe_id=recipe)
+            for recipe in rnd.sample(recipes, len(recipes) // 3)
+        )
+        ShoppingCart.objects.bulk_create(
+            ShoppingCart(user=reader, recipe_id=recipe)
+            for recipe in rnd.sample(recipes, min(len(recipes), 100))
+        )
+        return {
+            'reader': reader,
+            'token': Token.objects.create(user=reader).key,
+            'author': users[1],
+            'tag': tags[0],
+            'recipe': recipes[0],
+        }
+
+    def scenarios(self, fixtures):
+        recipe = fixtures['recipe']
+        return (
+            ('recipes-list-anonymous', False, '/api/recipes/'),
+            ('recipes-list-cached', False, '/api/recipes/'),
+            ('recipes-list-authenticated', True, '/api/recipes/'),
+            ('recipes-list-cursor', False, '/api/recipes/?cursor=&limit=6'),
+            ('recipes-list-tags', True,
+             f'/api/recipes/?tags={fixtures["tag"].slug}'),
+            ('recipes-list-author', True,
+             f'/api/recipes/?author={fixtures["author"].id}'),
+            ('recipes-list-is-favorited', True,
+             '/api/recipes/?is_favorited=1'),
+            ('recipes-search', True, '/api/recipes/?search=рецепт 1'),
+            ('recipes-following-feed', True, '/api/recipes/feed/'),
+            ('recipes-retrieve-anonymous', False, f'/api/recipes/{recipe}/'),
+            ('recipes-retrieve-authenticated', True,
+             f'/api/recipes/{recipe}/'),
+            ('users-list', True, '/api/users/'),
+            ('users-subscriptions', True,
+             '/api/users/subscriptions/?recipes_limit=3'),
+            ('download-shopping-cart', True,
+             '/api/recipes/download_shopping_cart/'),
+            ('ingredients-search', False, '/api/ingredients/?name=ингр'),
+        )
+
+    def run_scenarios(self, fixtures, repeat):
+        anonymous = APIClient(HTTP_HOST='localhost')
+        authenticated = APIClient(HTTP_HOST='localhost')
+        authenticated.credentials(
+            HTTP_AUTHORIZATION=f'Token {fixtures["token"]}'
+        )
+        results = []
+        for name, is_authenticated, path in self.scenarios(fixtures):
+            client = authenticated if is_authenticated else anonymous
+            response_size(client.get(path))
+            timings = []
+            for _ in range(repeat):
+                if name not in CACHED_SCENARIOS:
+                    bump_version('recipes')
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    response = client.get(path)
+                    size = response_size(response)
+                    timings.append((time.perf_counter() - started) * 1000)
+                if response.status_code != 200:
+                    raise CommandError(
+                        f'{name}: {path} вернул {response.status_code}'
+                    )
+            results.append({
+                'name': name,
+                'queries': len(queries),
+                'p50': percentile(timings, 50),
+                'p95': percentile(timings, 95),
+                'size': size,
+            })
+        return results
+
+    def recipe_view(self, path, user):
+        request = Request(APIRequestFactory().get(path, HTTP_HOST='localhost'))
+        request.user = user
+        return RecipeViewSet(request=request, action='list', format_kwarg=None)
+
+    def serializer_page(self, path, user):
+        view = self.recipe_view(path, user)
+        page = view.paginate_queryset(
+            view.filter_queryset(view.get_queryset())
+        )
+        return JSONRenderer().render(RecipeReadSerializer(
+            page, many=True, context={'request': view.request}
+        ).data)
+
+    def fast_page(self, path, user):
+        view = self.recipe_view(path, user)
+        page = view.paginate_queryset(
+            recipe_values(view.filter_queryset(view.get_queryset()))
+        )
+        return FastJSONRenderer().render(build_recipes(page, view.request))
+
+    def report_read_path(self, fixtures, repeat):
+        paths = (
+            '/api/recipes/?limit=50',
+            '/api/recipes/?cursor=&limit=50',
+            f'/api/recipes/?tags={fixtures["tag"].slug}&limit=50',
+            '/api/recipes/?search=рецепт&limit=50',
+        )
+        self.stdout.write(
+            f'{"страница ленты":<48}{"DRF, мс":>10}{"dict, мс":>10}'
+            f'{"ускорение":>11}'
+        )
+        for user in (AnonymousUser(), fixtures['reader']):
+            for path in paths:
+                role = 'auth' if user.is_authenticated else 'anon'
+                name = f'{path} ({role})'
+                timings = []
+                for build in (self.serializer_page, self.fast_page):
+                    started = time.process_time()
+                    for _ in range(repeat):
+                        build(path, user)
+                    timings.append(
+                        (time.process_time() - started) * 1000 / repeat
+                    )
+                self.stdout.write(
+                    f'{name:<48}{timings[0]:>10.2f}{timings[1]:>10.2f}'
+                    f'{timings[0] / timings[1]:>10.1f}x'
+                )
+
+    def plan_queries(self, fixtures):
+        view = self.recipe_view('/api/recipes/', fixtures['reader'])
+        return (
+            ('recipes-feed', view.get_queryset()[:6]),
+            ('recipes-author-feed',
+             view.get_queryset().filter(author=fixtures['author'])[:6]),
+            ('recipes-is-favorited',
+             view.get_queryset().filter(
+                 favorites__user=fixtures['reader']
+             )[:6]),
+            ('recipes-is-in-shopping-cart',
+             view.get_queryset().filter(cart__user=fixtures['reader'])[:6]),
+            ('recipes-search',
+             search_recipes(view.get_queryset(), 'рецепт')[:6]),
+            ('following-feed',
+             FeedItem.objects.filter(
+                 user=fixtures['reader']
+             ).order_by('-pub_date', '-id')[:6]),
+            ('ingredients-prefix',
+             Ingredient.objects.filter(name__istartswith='Ингр')),
+            ('recipes-name-prefix',
+             Recipe.objects.filter(name__istartswith='рецепт 1')),
+        )
+
+    def check_query_plans(self, fixtures):
+        if connection.vendor != 'postgresql':
+            self.stdout.write(self.style.WARNING(
+                'Проверка планов запросов поддерживается только в PostgreSQL'
+            ))
+            return []
+        failures = []
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+            # На маленькой выборке планировщик вправе выбрать Seq Scan,
+            # поэтому проверяем, что подходящий индекс вообще существует.
+            cursor.execute('SET enable_seqscan = off')
+            try:
+                for name, queryset in self.plan_queries(fixtures):
+                    plan = queryset.explain()
+                    scanned = [
+                        table for table in INDEXED_TABLES
+                        if f'Seq Scan on {table}' in plan
+                    ]
+                    if scanned:
+                        failures.append(
+                            f'{name}: Seq Scan по {", ".join(scanned)}\n{plan}'
+                        )
+            finally:
+                cursor.execute('RESET enable_seqscan')
+        return failures
+
+    def report(self, results, check_latency, failures=()):
+        failures = list(failures)
+        self.stdout.write(
+            f'{"сценарий":<32}{"запросы":>9}{"p50, мс":>10}'
+            f'{"p95, мс":>10}{"байт":>10}'
+        )
+        for result in results:
+            max_queries, max_p95 = BUDGETS[result['name']]
+            line = (
+                f'{result["name"]:<32}{result["queries"]:>9}'
+                f'{result["p50"]:>10.1f}{result["p95"]:>10.1f}'
+                f'{result["size"]:>10}'
+            )
+            over_budget = result['queries'] > max_queries or (
+                check_latency and result['p95'] > max_p95
+            )
+            if over_budget:
+                failures.append(
+                    f'{result["name"]}: {result["queries"]} запросов '
+                    f'(бюджет {max_queries}), p95 {result["p95"]:.1f} мс '
+                    f'(бюджет {max_p95} мс)'
+                )
+                self.stdout.write(self.style.ERROR(line))
+            else:
+                self.stdout.write(line)
+        if failures:
+            raise CommandError(
+                'Превышен бюджет:\n' + '\n'.join(failures)
+            )
+        self.stdout.write(
+            self.style.SUCCESS('Все сценарии уложились в бюджет')
+        )
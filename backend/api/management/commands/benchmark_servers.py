@@ -0,0 +1,187 @@
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (
+    setup_test_environment,
+    teardown_test_environment
+)
+
+from .benchmark_api import Command as BenchmarkCommand
+from .benchmark_api import percentile
+
+HOST = '127.0.0.1'
+SERVERS = {
+    'wsgi': lambda port, workers: [
+        sys.executable, '-m', 'gunicorn', 'foodgram.wsgi:application',
+        '--bind', f'{HOST}:{port}', '--workers', str(workers),
+    ],
+    'asgi': lambda port, workers: [
+        sys.executable, '-m', 'uvicorn', 'foodgram.asgi:application',
+        '--host', HOST, '--port', str(port), '--workers', str(workers),
+        '--log-level', 'warning', '--no-access-log',
+    ],
+}
+
+
+def comma_separated(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def fetch(port, path, headers):
+    client = http.client.HTTPConnection(HOST, port, timeout=30)
+    started = time.perf_counter()
+    try:
+        client.request('GET', path, headers=headers)
+        response = client.getresponse()
+        response.read()
+        ok = response.status == 200
+    except OSError:
+        ok = False
+    finally:
+        client.close()
+    return (time.perf_counter() - started) * 1000, ok
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает пропускную способность и задержки gunicorn (WSGI) '
+        'и uvicorn (ASGI) на эндпоинтах чтения при разной конкурентности.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--recipes', type=int, default=300)
+        parser.add_argument('--ingredients', type=int, default=500)
+        parser.add_argument('--ingredients-per-recipe', type=int, default=8)
+        parser.add_argument('--workers', type=int, default=2)
+        parser.add_argument('--requests', type=int, default=400)
+        parser.add_argument(
+            '--concurrency',
+            type=lambda value: [int(item) for item in comma_separated(value)],
+            default=[1, 8, 32, 64]
+        )
+        parser.add_argument(
+            '--servers',
+            type=comma_separated,
+            default=list(SERVERS)
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError(
+                'Серверам нужна общая база, поддерживается только PostgreSQL'
+            )
+        unknown = set(options['servers']) - set(SERVERS)
+        if unknown:
+            raise CommandError(f'Неизвестные серверы: {", ".join(unknown)}')
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        test_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False
+        )
+        results = []
+        try:
+            fixtures = BenchmarkCommand().prepare(options)
+            paths = (
+                '/api/recipes/',
+                f'/api/recipes/{fixtures["recipe"]}/',
+                '/api/tags/',
+                '/api/ingredients/?' + urlencode({'name': 'ингр'}),
+            )
+            headers = {'Authorization': f'Token {fixtures["token"]}'}
+            for server in options['servers']:
+                results += self.benchmark_server(
+                    server, test_name, paths, headers, options
+                )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+        self.report(results)
+
+    def benchmark_server(self, server, database, paths, headers, options):
+        port = free_port()
+        env = dict(os.environ, POSTGRES_DB=database)
+        process = subprocess.Popen(
+            SERVERS[server](port, options['workers']),
+            cwd=settings.BASE_DIR,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            self.wait_until_ready(process, port)
+            for path in paths:
+                fetch(port, path, headers)
+            return [
+                self.run_level(server, port, paths, headers, concurrency,
+                               options['requests'])
+                for concurrency in options['concurrency']
+            ]
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+
+    def wait_until_ready(self, process, port, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise CommandError(
+                    f'Сервер завершился с кодом {process.returncode}'
+                )
+            try:
+                with socket.create_connection((HOST, port), timeout=1):
+                    return
+            except OSError:
+                time.sleep(0.2)
+        raise CommandError(f'Сервер не запустился за {timeout} секунд')
+
+    def run_level(self, server, port, paths, headers, concurrency, requests):
+        jobs = [paths[number % len(paths)] for number in range(requests)]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            responses = list(executor.map(
+                lambda path: fetch(port, path, headers), jobs
+            ))
+        elapsed = time.perf_counter() - started
+        timings = [timing for timing, ok in responses if ok]
+        return {
+            'server': server,
+            'concurrency': concurrency,
+            'rps': len(timings) / elapsed,
+            'p50': percentile(timings, 50) if timings else 0,
+            'p95': percentile(timings, 95) if timings else 0,
+            'p99': percentile(timings, 99) if timings else 0,
+            'errors': len(responses) - len(timings),
+        }
+
+    def report(self, results):
+        self.stdout.write(
+            f'{"сервер":<8}{"потоков":>9}{"запр/с":>10}{"p50, мс":>10}'
+            f'{"p95, мс":>10}{"p99, мс":>10}{"ошибок":>8}'
+        )
+        for result in results:
+            line = (
+                f'{result["server"]:<8}{result["concurrency"]:>9}'
+                f'{result["rps"]:>10.1f}{result["p50"]:>10.1f}'
+                f'{result["p95"]:>10.1f}{result["p99"]:>10.1f}'
+                f'{result["errors"]:>8}'
+            )
+            if result['errors']:
+                self.stdout.write(self.style.ERROR(line))
+            else:
+                self.stdout.write(line)
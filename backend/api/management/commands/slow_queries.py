@@ -0,0 +1,60 @@
+from django.core.management import BaseCommand, CommandError
+
+from api.slow_queries import collect, is_shared_cache, reset
+
+SORT_KEYS = ('total', 'count', 'max', 'avg')
+
+
+class Command(BaseCommand):
+    help = (
+        'Показывает самые дорогие SQL-запросы, собранные обёрткой '
+        'медленных запросов, с разбивкой по вьюхам и командам.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=20)
+        parser.add_argument('--sort', choices=SORT_KEYS, default='total')
+        parser.add_argument(
+            '--label',
+            help='Показать только запросы этой вьюхи или команды.'
+        )
+        parser.add_argument(
+            '--reset',
+            action='store_true',
+            help='Очистить собранную статистику.'
+        )
+
+    def handle(self, *args, **options):
+        if not is_shared_cache():
+            raise CommandError(
+                'Статистика воркеров хранится в кэше Django, а текущий '
+                'бэкенд виден только этому процессу. Укажите общий кэш '
+                'в CACHE_BACKEND: файловый, Redis или Memcached.'
+            )
+        if options['reset']:
+            reset()
+            self.stdout.write(self.style.SUCCESS('Статистика очищена'))
+            return
+        entries = collect()
+        for entry in entries:
+            entry['avg'] = entry['total'] / entry['count']
+        if options['label']:
+            entries = [
+                entry for entry in entries
+                if entry['label'] == options['label']
+            ]
+        entries.sort(key=lambda entry: entry[options['sort']], reverse=True)
+        if not entries:
+            self.stdout.write('Медленных запросов не найдено')
+            return
+        self.stdout.write(
+            f'{"раз":>8}{"всего, мс":>12}{"макс, мс":>10}'
+            f'{"средн, мс":>11}  источник'
+        )
+        for entry in entries[:options['limit']]:
+            self.stdout.write(
+                f'{entry["count"]:>8}{entry["total"]:>12.1f}'
+                f'{entry["max"]:>10.1f}{entry["avg"]:>11.1f}  '
+                f'{entry["label"]}'
+            )
+            self.stdout.write(f'    {entry["fingerprint"]}')
@@ -0,0 +1,132 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from .feed_cache import feed_cache_stats
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+QUERIES_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+BYTES_BUCKETS = (512, 2048, 8192, 32768, 131072, 524288, 2097152)
+
+HISTOGRAMS = {
+    'duration_seconds': ('Время обработки запроса', SECONDS_BUCKETS),
+    'db_seconds': ('Время SQL-запросов', SECONDS_BUCKETS),
+    'render_seconds': ('Время сериализации ответа', SECONDS_BUCKETS),
+    'queries': ('Число SQL-запросов', QUERIES_BUCKETS),
+    'response_bytes': ('Размер ответа', BYTES_BUCKETS),
+}
+PREFIX = 'foodgram_request_'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+current_metrics = ContextVar('current_metrics', default=None)
+
+
+class RequestMetrics:
+    __slots__ = ('started', 'queries', 'db_time', 'render_time', 'rendering')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.rendering = False
+
+
+def execute_wrapper(execute, sql, params, many, context):
+    # Метрики берём из контекста запроса: так считаются и запросы,
+    # которые ASGI выполняет в пуле потоков.
+    metrics = current_metrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.queries += 1
+        metrics.db_time += time.perf_counter() - started
+
+
+def install(sender, connection, **kwargs):
+    if execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, execute_wrapper)
+
+
+@contextmanager
+def measure_render():
+    # Сериализатор внутри сериализатора считаем один раз, а SQL,
+    # выполненный по ходу, уже попал в db и из render вычитается.
+    metrics = current_metrics.get()
+    if metrics is None or metrics.rendering:
+        yield
+        return
+    metrics.rendering = True
+    started = time.perf_counter()
+    db_time = metrics.db_time
+    try:
+        yield
+    finally:
+        metrics.rendering = False
+        metrics.render_time += (
+            time.perf_counter() - started - (metrics.db_time - db_time)
+        )
+
+
+def escape_label(value):
+    return (
+        value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    )
+
+
+class MetricsRegistry:
+    # Гистограммы живут в памяти процесса: каждый воркер отдаёт свои.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def observe(self, route, values):
+        with self._lock:
+            for name, value in values.items():
+                buckets = HISTOGRAMS[name][1]
+                counts = self._histograms.setdefault(
+                    (name, route), [[0] * (len(buckets) + 1), 0]
+                )
+                counts[0][bisect_left(buckets, value)] += 1
+                counts[1] += value
+
+    def render(self):
+        with self._lock:
+            histograms = {
+                key: (list(counts), total)
+                for key, (counts, total) in self._histograms.items()
+            }
+        lines = []
+        for name, (description, buckets) in HISTOGRAMS.items():
+            metric = PREFIX + name
+            lines.append(f'# HELP {metric} {description}')
+            lines.append(f'# TYPE {metric} histogram')
+            for (histogram, route), (counts, total) in sorted(
+                histograms.items()
+            ):
+                if histogram != name:
+                    continue
+                label = f'route="{escape_label(route)}"'
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(
+                        f'{metric}_bucket{{{label},le="{bound}"}} '
+                        f'{cumulative}'
+                    )
+                lines.append(f'{metric}_sum{{{label}}} {total}')
+                lines.append(f'{metric}_count{{{label}}} {cumulative}')
+        for name, value in feed_cache_stats().items():
+            metric = f'foodgram_recipes_feed_cache_{name}_total'
+            lines.append(f'# TYPE {metric} counter')
+            lines.append(f'{metric} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,81 @@
+import asyncio
+import time
+
+from .metrics import RequestMetrics, current_metrics, registry
+from .slow_queries import query_label, view_label
+
+
+class PerformanceMiddleware:
+    # Замеряет SQL, сериализацию и размер ответа у вьюх api.views,
+    # отдаёт их в Server-Timing и копит гистограммы по маршрутам.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        metrics, tokens = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            self.reset(tokens)
+        return self.finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        metrics, tokens = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            self.reset(tokens)
+        return self.finish(request, response, metrics)
+
+    def start(self, request):
+        metrics = RequestMetrics()
+        return metrics, (
+            current_metrics.set(metrics),
+            query_label.set(f'{request.method} {request.path}'),
+        )
+
+    def reset(self, tokens):
+        metrics_token, label_token = tokens
+        current_metrics.reset(metrics_token)
+        query_label.reset(label_token)
+
+    def finish(self, request, response, metrics):
+        route = self.get_route(request)
+        if route is None:
+            return response
+        duration = time.perf_counter() - metrics.started
+        values = {
+            'duration_seconds': duration,
+            'db_seconds': metrics.db_time,
+            'render_seconds': metrics.render_time,
+            'queries': metrics.queries,
+        }
+        if not response.streaming:
+            values['response_bytes'] = len(response.content)
+        registry.observe(route, values)
+        app_time = duration - metrics.db_time - metrics.render_time
+        response['Server-Timing'] = (
+            f'db;dur={metrics.db_time * 1000:.1f};'
+            f'desc="{metrics.queries} SQL", '
+            f'render;dur={metrics.render_time * 1000:.1f}, '
+            f'app;dur={max(app_time, 0) * 1000:.1f}, '
+            f'total;dur={duration * 1000:.1f}'
+        )
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        query_label.set(view_label(view_func, request.method))
+
+    def get_route(self, request):
+        match = getattr(request, 'resolver_match', None)
+        view = getattr(match.func, 'cls', None) if match else None
+        if view is None or view.__module__ != 'api.views':
+            return None
+        return match.view_name
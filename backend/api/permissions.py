@@ -1,3 +1,6 @@
+import hmac
+
+from django.conf import settings
 from rest_framework import permissions
 
 
@@ -6,3 +9,18 @@ class IsOwnerOrReadOnly(permissions.BasePermission):
         if request.method in permissions.SAFE_METHODS:
             return True
         return obj.author == request.user
+
+
+class IsInternalIP(permissions.BasePermission):
+    def has_permission(self, request, view):
+        return request.META.get('REMOTE_ADDR') in settings.INTERNAL_IPS
+
+
+class HasMetricsToken(permissions.BasePermission):
+    def has_permission(self, request, view):
+        if not settings.METRICS_TOKEN:
+            return False
+        header = request.META.get('HTTP_AUTHORIZATION', '')
+        return hmac.compare_digest(
+            header.encode(), f'Bearer {settings.METRICS_TOKEN}'.encode()
+        )
@@ -0,0 +1,106 @@
+from collections import defaultdict
+
+from recipes.models import IngredientInRecipe, Recipe
+
+from .metrics import measure_render
+from .serializers import RecipeReadSerializer
+from .utils import derivative_urls, get_subscribed_author_ids, media_url
+
+# Колонки, которые нужны каждому полю ответа.
+VALUES = {
+    'author': (
+        'author_id',
+        'author__email',
+        'author__username',
+        'author__first_name',
+        'author__last_name',
+    ),
+    'name': ('name',),
+    'image': ('image',),
+    'images': ('image',),
+    'text': ('text',),
+    'cooking_time': ('cooking_time',),
+}
+FLAGS = ('is_favorited', 'is_in_shopping_cart')
+
+
+def recipe_values(queryset, fields=None):
+    fields = fields or RecipeReadSerializer.Meta.fields
+    columns = {'id': None, 'pub_date': None}
+    for name in fields:
+        columns.update(dict.fromkeys(VALUES.get(name, ())))
+        if name in FLAGS and name in queryset.query.annotations:
+            columns[name] = None
+    return queryset.prefetch_related(None).values(*columns)
+
+
+def tags_by_recipe(ids):
+    tags = defaultdict(list)
+    rows = Recipe.tags.through.objects.filter(
+        recipe_id__in=ids
+    ).order_by('tag_id').values_list(
+        'recipe_id', 'tag_id', 'tag__name', 'tag__color', 'tag__slug'
+    )
+    for recipe_id, pk, name, color, slug in rows:
+        tags[recipe_id].append(
+            {'id': pk, 'name': name, 'color': color, 'slug': slug}
+        )
+    return tags
+
+
+def ingredients_by_recipe(ids):
+    ingredients = defaultdict(list)
+    rows = IngredientInRecipe.objects.filter(recipe_id__in=ids).values_list(
+        'recipe_id', 'ingredient_id', 'ingredient__name',
+        'ingredient__measurement_unit', 'amount'
+    )
+    for recipe_id, pk, name, measurement_unit, amount in rows:
+        ingredients[recipe_id].append({
+            'id': pk,
+            'name': name,
+            'measurement_unit': measurement_unit,
+            'amount': amount,
+        })
+    return ingredients
+
+
+@measure_render()
+def build_recipes(rows, request, fields=None):
+    # Повторяет RecipeReadSerializer без полей DRF: на странице ленты
+    # именно они съедали большую часть времени.
+    fields = fields or RecipeReadSerializer.Meta.fields
+    ids = [row['id'] for row in rows]
+    tags = tags_by_recipe(ids) if 'tags' in fields else None
+    ingredients = (
+        ingredients_by_recipe(ids) if 'ingredients' in fields else None
+    )
+    subscribed = (
+        get_subscribed_author_ids(request)
+        if 'author' in fields and request.user.is_authenticated else ()
+    )
+    builders = {
+        'id': lambda row: row['id'],
+        'tags': lambda row: tags[row['id']],
+        'author': lambda row: {
+            'email': row['author__email'],
+            'id': row['author_id'],
+            'username': row['author__username'],
+            'first_name': row['author__first_name'],
+            'last_name': row['author__last_name'],
+            'is_subscribed': row['author_id'] in subscribed,
+        },
+        'ingredients': lambda row: ingredients[row['id']],
+        'is_favorited': lambda row: row.get('is_favorited', False),
+        'is_in_shopping_cart': (
+            lambda row: row.get('is_in_shopping_cart', False)
+        ),
+        'name': lambda row: row['name'],
+        'image': lambda row: (
+            media_url(row['image'], request) if row['image'] else None
+        ),
+        'images': lambda row: derivative_urls(row['image'], request),
+        'text': lambda row: row['text'],
+        'cooking_time': lambda row: row['cooking_time'],
+    }
+    selected = [(name, builders[name]) for name in fields]
+    return [{name: build(row) for name, build in selected} for row in rows]
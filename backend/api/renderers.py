@@ -0,0 +1,64 @@
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils import encoders
+
+from .metrics import measure_render
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    ORJSON_OPTIONS = 0
+else:
+    # Даты отдаём кодировщику DRF: он пишет «Z» вместо «+00:00»
+    # и обрезает микросекунды до миллисекунд.
+    ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+class PlainTextRenderer(BaseRenderer):
+    media_type = 'text/plain'
+    format = 'txt'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if isinstance(data, dict):
+            data = '\n'.join(f'{key}: {value}' for key, value in data.items())
+        return str(data).encode(self.charset)
+
+
+class CSVRenderer(PlainTextRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class FastJSONRenderer(JSONRenderer):
+    # Тот же JSON, что у JSONRenderer, но через orjson, если он установлен.
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with measure_render():
+            return self.render_json(
+                data, accepted_media_type, renderer_context
+            )
+
+    def render_json(self, data, accepted_media_type, renderer_context):
+        if orjson is None or data is None or self.get_indent(
+            accepted_media_type, renderer_context or {}
+        ):
+            return super().render(
+                data, accepted_media_type, renderer_context
+            )
+        try:
+            content = orjson.dumps(
+                data,
+                default=encoders.JSONEncoder().default,
+                option=ORJSON_OPTIONS
+            )
+        except TypeError:
+            # Например, целые шире 64 бит: их умеет только json.
+            return super().render(
+                data, accepted_media_type, renderer_context
+            )
+        return content.replace(
+            b'\xe2\x80\xa8', b'\\u2028'
+        ).replace(b'\xe2\x80\xa9', b'\\u2029')
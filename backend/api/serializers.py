@@ -1,25 +1,48 @@
 from django.contrib.auth import get_user_model
-from django.shortcuts import get_object_or_404
+from django.db import transaction
+from django.db.models import prefetch_related_objects
 from djoser.serializers import UserSerializer as DjoserSerializer
 from rest_framework import serializers
 from rest_framework.fields import SerializerMethodField
 from drf_extra_fields.fields import Base64ImageField
-from rest_framework.validators import UniqueTogetherValidator
 from rest_framework.serializers import BooleanField
 from recipes.models import (
     Ingredient,
     Tag,
     Recipe,
-    IngredientInRecipe,
-    Subscription,
-    Favorite,
-    ShoppingCart
+    IngredientInRecipe
+)
+from recipes.similarity import schedule_similar_recipes_update
+from .metrics import measure_render
+from .utils import (
+    derivative_urls,
+    get_recipes_limit,
+    get_subscribed_author_ids
 )
 
 User = get_user_model()
 
 
-class UserSerializer(DjoserSerializer):
+class SparseFieldsMixin:
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+class TimedSerializerMixin:
+    # Время сборки ответа попадает в render из Server-Timing.
+    def to_representation(self, instance):
+        with measure_render():
+            return super().to_representation(instance)
+
+
+class UserSerializer(
+    TimedSerializerMixin,
+    SparseFieldsMixin,
+    DjoserSerializer
+):
     is_subscribed = SerializerMethodField()
 
     class Meta:
@@ -34,16 +57,18 @@ class UserSerializer(DjoserSerializer):
         )
 
     def get_is_subscribed(self, obj):
-        user = self.context.get('request').user
-        if user is None or user.is_anonymous:
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
+        request = self.context.get('request')
+        if request is None or request.user.is_anonymous:
             return False
-        return Subscription.objects.filter(
-            user=user,
-            author=obj
-        ).exists()
+        return obj.id in get_subscribed_author_ids(request)
 
 
-class IngredientSerializer(serializers.ModelSerializer):
+class IngredientSerializer(
+    TimedSerializerMixin,
+    serializers.ModelSerializer
+):
     id = serializers.PrimaryKeyRelatedField(read_only=True)
 
     class Meta:
@@ -51,7 +76,10 @@ class IngredientSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'measurement_unit')
 
 
-class TagSerializer(serializers.ModelSerializer):
+class TagSerializer(
+    TimedSerializerMixin,
+    serializers.ModelSerializer
+):
     id = serializers.PrimaryKeyRelatedField(read_only=True)
 
     class Meta:
@@ -87,7 +115,19 @@ class IngredientInRecipeWriteSerializer(serializers.ModelSerializer):
         )
 
 
-class RecipeReadSerializer(serializers.ModelSerializer):
+class RecipeImagesMixin(serializers.Serializer):
+    images = SerializerMethodField()
+
+    def get_images(self, obj):
+        return derivative_urls(obj.image.name, self.context.get('request'))
+
+
+class RecipeReadSerializer(
+    TimedSerializerMixin,
+    SparseFieldsMixin,
+    RecipeImagesMixin,
+    serializers.ModelSerializer
+):
     author = UserSerializer(read_only=True)
     tags = TagSerializer(many=True, read_only=True)
     image = Base64ImageField(read_only=True)
@@ -109,6 +149,7 @@ class RecipeReadSerializer(serializers.ModelSerializer):
             'is_in_shopping_cart',
             'name',
             'image',
+            'images',
             'text',
             'cooking_time',
         )
@@ -117,7 +158,7 @@ class RecipeReadSerializer(serializers.ModelSerializer):
 class RecipeWriteSerializer(serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
     ingredients = IngredientInRecipeWriteSerializer(many=True)
-    image = Base64ImageField()
+    image = Base64ImageField(required=False)
 
     class Meta:
         model = Recipe
@@ -132,16 +173,63 @@ class RecipeWriteSerializer(serializers.ModelSerializer):
             'cooking_time',
         )
 
+    def validate_ingredients(self, ingredients):
+        ids = [ingredient['id'] for ingredient in ingredients]
+        if len(ids) != len(set(ids)):
+            raise serializers.ValidationError(
+                'Ингредиенты не должны повторяться'
+            )
+        missing = set(ids) - set(Ingredient.objects.in_bulk(ids))
+        if missing:
+            raise serializers.ValidationError(
+                'Нет ингредиентов с id: '
+                + ', '.join(str(pk) for pk in sorted(missing))
+            )
+        return ingredients
+
     def create_ingredients(self, ingredients, recipe):
-        queryset = Ingredient.objects.all()
         IngredientInRecipe.objects.bulk_create([
             IngredientInRecipe(
-                ingredient=get_object_or_404(queryset, id=ingredient['id']),
+                ingredient_id=ingredient['id'],
                 recipe=recipe,
                 amount=ingredient['amount']
             ) for ingredient in ingredients
         ])
+        # bulk_create не шлёт сигналы, индекс похожих обновляем сами.
+        schedule_similar_recipes_update(recipe.pk)
+
+    def update_ingredients(self, ingredients, recipe):
+        amounts = {
+            ingredient['id']: ingredient['amount']
+            for ingredient in ingredients
+        }
+        existing = {
+            row.ingredient_id: row
+            for row in IngredientInRecipe.objects.filter(recipe=recipe)
+        }
+        removed = existing.keys() - amounts.keys()
+        if removed:
+            IngredientInRecipe.objects.filter(
+                recipe=recipe,
+                ingredient_id__in=removed
+            ).delete()
+        changed = []
+        for ingredient_id, row in existing.items():
+            amount = amounts.get(ingredient_id)
+            if amount is not None and amount != row.amount:
+                row.amount = amount
+                changed.append(row)
+        if changed:
+            IngredientInRecipe.objects.bulk_update(changed, ['amount'])
+        self.create_ingredients(
+            [
+                ingredient for ingredient in ingredients
+                if ingredient['id'] not in existing
+            ],
+            recipe
+        )
 
+    @transaction.atomic
     def create(self, validated_data):
         tags = validated_data.pop('tags')
         ingredients = validated_data.pop('ingredients')
@@ -150,93 +238,71 @@ class RecipeWriteSerializer(serializers.ModelSerializer):
         self.create_ingredients(recipe=recipe, ingredients=ingredients)
         return recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
-        tags = validated_data.pop('tags')
-        ingredients = validated_data.pop('ingredients')
-        instance.tags.set(tags)
-        IngredientInRecipe.objects.filter(recipe=instance).delete()
-        super().update(instance, validated_data)
-        self.create_ingredients(ingredients, instance)
-        instance.save()
-        return instance
+        tags = validated_data.pop('tags', None)
+        ingredients = validated_data.pop('ingredients', None)
+        if tags is not None:
+            instance.tags.set(tags)
+        if ingredients is not None:
+            self.update_ingredients(ingredients, instance)
+        return super().update(instance, validated_data)
 
     def to_representation(self, instance):
         request = self.context.get('request')
         context = {'request': request}
+        prefetch_related_objects(
+            [instance], 'ingredient__ingredient', 'tags'
+        )
         return RecipeReadSerializer(
             instance,
             context=context
         ).data
 
 
-class RecipeFavoriteSerializer(serializers.ModelSerializer):
+class RecipeImageSerializer(
+    TimedSerializerMixin,
+    serializers.ModelSerializer
+):
+    image = serializers.ImageField()
+
+    class Meta:
+        model = Recipe
+        fields = ('image',)
+
+
+class RecipeFavoriteSerializer(
+    TimedSerializerMixin,
+    RecipeImagesMixin,
+    serializers.ModelSerializer
+):
     class Meta:
         model = Recipe
         fields = (
             'id',
             'name',
             'image',
+            'images',
             'cooking_time'
         )
 
 
-class FavoriteAndShoppingCartSerializerBase(serializers.ModelSerializer):
-    class Meta:
-        model = Favorite
-        abstract = True
-        fields = (
-            'user',
-            'recipe'
-        )
-
-    def validate(self, data):
-        user = data['user']
-        recipe = data['recipe']
-        if self.Meta.model.objects.filter(user=user, recipe=recipe).exists():
-            raise serializers.ValidationError(
-                f'Такой рецепт уже есть в \
-                {self.Meta.model._meta.verbose_name_plural} '
-            )
-        return data
-
-
-class FavoriteSerializer(FavoriteAndShoppingCartSerializerBase):
-    class Meta(FavoriteAndShoppingCartSerializerBase.Meta):
-        pass
-
-
-class ShoppingCartSerializer(FavoriteAndShoppingCartSerializerBase):
-    class Meta(FavoriteAndShoppingCartSerializerBase.Meta):
-        model = ShoppingCart
-
-
-class SubscriptionSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = Subscription
-        fields = (
-            'user',
-            'author'
-        )
-        validators = [
-            UniqueTogetherValidator(
-                queryset=Subscription.objects.all(),
-                fields=['user', 'author'],
-                message='Дважды на одного пользователя нельзя подписаться'
-            )
-        ]
-
-    def validate(self, data):
-        if data['author'] == data['user']:
-            raise serializers.ValidationError('Нельзя подписаться на себя')
-        return data
-
-
 class SubscriptionReadSerializer(UserSerializer):
-    recipes = RecipeFavoriteSerializer(many=True, read_only=True)
-    recipes_count = SerializerMethodField(read_only=True)
+    recipes = SerializerMethodField(read_only=True)
 
     class Meta(UserSerializer.Meta):
         fields = UserSerializer.Meta.fields + ('recipes', 'recipes_count')
 
-    def get_recipes_count(self, obj):
-        return obj.recipes.count()
+    def get_recipes(self, obj):
+        if hasattr(obj, 'recipes_preview'):
+            recipes = obj.recipes_preview
+        else:
+            recipes = obj.recipes.all()
+            limit = get_recipes_limit(self.context.get('request'))
+            if limit is not None:
+                recipes = recipes[:limit]
+        return RecipeFavoriteSerializer(
+            recipes,
+            many=True,
+            context=self.context
+        ).data
@@ -0,0 +1,177 @@
+import atexit
+import os
+import re
+import socket
+import sys
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+INDEX_KEY = 'slow-queries:index'
+STORE_TIMEOUT = 24 * 60 * 60
+
+query_label = ContextVar('query_label', default=None)
+
+FINGERPRINT_RULES = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'(?<![\w"])-?\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'%s'), '?'),
+    (re.compile(r'\(\?(?:\s*,\s*\?)+\)'), '(...)'),
+    (re.compile(r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+'), '(...)'),
+    (re.compile(r'\s+'), ' '),
+)
+
+
+def fingerprint(sql):
+    for pattern, replacement in FINGERPRINT_RULES:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+def default_label():
+    # Вне вьюх запросы приписываем команде manage.py или процессу.
+    if len(sys.argv) > 1 and sys.argv[0].endswith('manage.py'):
+        return f'command:{sys.argv[1]}'
+    return os.path.basename(sys.argv[0]) if sys.argv else 'unknown'
+
+
+def view_label(view_func, method):
+    view = getattr(view_func, 'cls', None)
+    if view is None:
+        return getattr(view_func, '__name__', 'view')
+    action = (getattr(view_func, 'actions', None) or {}).get(method.lower())
+    return f'{view.__name__}.{action}' if action else view.__name__
+
+
+class SlowQueryStore:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.key = f'slow-queries:{socket.gethostname()}:{os.getpid()}'
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._entries = {}
+        self._flushed = time.monotonic()
+        self._pending = False
+
+    def record(self, label, sql, duration):
+        key = (label, fingerprint(sql))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if len(self._entries) >= self.max_size:
+                    # Вытесняем запрос, который суммарно стоил меньше всех.
+                    del self._entries[min(
+                        self._entries,
+                        key=lambda item: self._entries[item]['total']
+                    )]
+                entry = self._entries[key] = {
+                    'label': label,
+                    'fingerprint': key[1],
+                    'count': 0,
+                    'total': 0.0,
+                    'max': 0.0,
+                }
+            entry['count'] += 1
+            entry['total'] += duration
+            entry['max'] = max(entry['max'], duration)
+            self._pending = True
+
+    def snapshot(self):
+        with self._lock:
+            return [dict(entry) for entry in self._entries.values()]
+
+    def flush(self):
+        # Кэш может сам ходить в базу, поэтому его запросы не считаем.
+        if getattr(self._local, 'flushing', False):
+            return
+        self._local.flushing = True
+        try:
+            self._flushed = time.monotonic()
+            self._pending = False
+            cache.set(self.key, self.snapshot(), timeout=STORE_TIMEOUT)
+            snapshots = live_snapshots()
+            if self.key not in snapshots:
+                cache.set(INDEX_KEY, [*snapshots, self.key], timeout=None)
+        finally:
+            self._local.flushing = False
+
+    def maybe_flush(self):
+        interval = settings.SLOW_QUERY_FLUSH_INTERVAL
+        if self._pending and time.monotonic() - self._flushed >= interval:
+            self.flush()
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        if getattr(self._local, 'flushing', False):
+            return execute(sql, params, many, context)
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = (time.perf_counter() - started) * 1000
+            if duration >= settings.SLOW_QUERY_THRESHOLD_MS:
+                self.record(
+                    query_label.get() or default_label(), sql, duration
+                )
+                self.maybe_flush()
+
+
+def is_shared_cache():
+    return not isinstance(caches['default'], (LocMemCache, DummyCache))
+
+
+def live_snapshots():
+    # Снимки умерших воркеров истекают через STORE_TIMEOUT, их ключи
+    # убираем из индекса, чтобы он не рос с каждым перезапуском.
+    keys = cache.get(INDEX_KEY) or []
+    snapshots = cache.get_many(keys)
+    if len(snapshots) != len(keys):
+        cache.set(
+            INDEX_KEY,
+            [key for key in keys if key in snapshots],
+            timeout=None
+        )
+    return snapshots
+
+
+def collect():
+    entries = {}
+    for snapshot in live_snapshots().values():
+        for entry in snapshot:
+            total = entries.setdefault(
+                (entry['label'], entry['fingerprint']),
+                dict(entry, count=0, total=0.0, max=0.0)
+            )
+            total['count'] += entry['count']
+            total['total'] += entry['total']
+            total['max'] = max(total['max'], entry['max'])
+    return list(entries.values())
+
+
+def reset():
+    for key in cache.get(INDEX_KEY) or []:
+        cache.delete(key)
+    cache.delete(INDEX_KEY)
+
+
+store = SlowQueryStore(settings.SLOW_QUERY_MAX_FINGERPRINTS)
+
+
+def install(sender, connection, **kwargs):
+    # Ставим обёртку в начало: execute_wrapper() снимает с конца
+    # только свои временные обёртки.
+    if store.execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, store.execute_wrapper)
+
+
+def flush_on_request_finished(sender, **kwargs):
+    # Без этого записи ждали бы следующего медленного запроса,
+    # которого на тихом воркере может не быть вовсе.
+    store.maybe_flush()
+
+
+atexit.register(lambda: store.snapshot() and store.flush())
@@ -0,0 +1,542 @@
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from io import BytesIO
+from unittest import mock, skipUnless
+
+from PIL import Image
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils.translation import gettext_lazy
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+
+from .feed_cache import feed_cache_stats
+from .recipe_reader import build_recipes, recipe_values
+from .renderers import FastJSONRenderer
+from .serializers import RecipeReadSerializer
+from .slow_queries import store
+from .views import RecipeViewSet
+from recipes.counters import recount
+from recipes.models import (
+    Favorite,
+    Ingredient,
+    IngredientInRecipe,
+    Recipe,
+    ShoppingCart,
+    Subscription,
+    Tag,
+    User
+)
+from recipes.search import update_search_index
+from recipes.similarity import (
+    read,
+    rebuild_similar_recipes,
+    similar_recipes,
+    update_similar_recipes
+)
+from recipes.versions import get_version
+
+# Тесты не трогают файловый кэш разработчика.
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+}
+NO_DRIFT = {
+    'recipe.favorites_count': 0,
+    'recipe.carts_count': 0,
+    'user.recipes_count': 0,
+    'user.subscribers_count': 0,
+}
+
+
+def create_user(number):
+    return User.objects.create_user(
+        username=f'user{number}',
+        email=f'user{number}@example.com',
+        first_name='Имя',
+        last_name='Фамилия',
+        password='password'
+    )
+
+
+def create_recipe(author, number):
+    return Recipe.objects.create(
+        author=author, name=f'Рецепт {number}', text='Текст', cooking_time=5
+    )
+
+
+def authorized_client(user):
+    client = APIClient()
+    client.credentials(
+        HTTP_AUTHORIZATION=f'Token {Token.objects.get_or_create(user=user)[0]}'
+    )
+    return client
+
+
+@override_settings(CACHES=CACHES)
+class LinkToggleTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user(1)
+        cls.author = create_user(2)
+        cls.recipe = create_recipe(cls.author, 1)
+        cls.other_recipe = create_recipe(cls.author, 2)
+
+    def setUp(self):
+        self.client = authorized_client(self.user)
+
+    def assert_no_drift(self):
+        self.assertEqual(recount(dry_run=True), NO_DRIFT)
+
+    def test_favorite_and_cart_toggle(self):
+        for url, link_model in (
+            (f'/api/recipes/{self.recipe.pk}/favorite/', Favorite),
+            (f'/api/recipes/{self.recipe.pk}/shopping_cart/', ShoppingCart),
+        ):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.post(url).status_code, 201)
+                self.assertEqual(self.client.post(url).status_code, 400)
+                self.assertEqual(link_model.objects.count(), 1)
+                self.assert_no_drift()
+                self.assertEqual(self.client.delete(url).status_code, 204)
+                self.assertEqual(self.client.delete(url).status_code, 404)
+                self.assertFalse(link_model.objects.exists())
+                self.assert_no_drift()
+
+    def test_favorites_count(self):
+        url = f'/api/recipes/{self.recipe.pk}/favorite/'
+        self.client.post(url)
+        authorized_client(self.author).post(url)
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.favorites_count, 2)
+        self.client.delete(url)
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.favorites_count, 1)
+
+    def test_missing_recipe(self):
+        for method in ('post', 'delete'):
+            with self.subTest(method=method):
+                response = getattr(self.client, method)(
+                    '/api/recipes/999999/favorite/'
+                )
+                self.assertEqual(response.status_code, 404)
+
+    def test_subscribe_toggle(self):
+        url = f'/api/users/{self.author.pk}/subscribe/'
+        self.assertEqual(self.client.post(url).status_code, 201)
+        self.assertEqual(self.client.post(url).status_code, 400)
+        self.author.refresh_from_db()
+        self.assertEqual(self.author.subscribers_count, 1)
+        self.assertEqual(self.client.delete(url).status_code, 204)
+        self.assertEqual(self.client.delete(url).status_code, 404)
+        self.author.refresh_from_db()
+        self.assertEqual(self.author.subscribers_count, 0)
+        self.assert_no_drift()
+
+    def test_subscribe_to_self(self):
+        response = self.client.post(f'/api/users/{self.user.pk}/subscribe/')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Subscription.objects.exists())
+
+    def test_anonymous(self):
+        response = APIClient().post(f'/api/recipes/{self.recipe.pk}/favorite/')
+        self.assertEqual(response.status_code, 401)
+
+    def test_batch_favorite(self):
+        Favorite.objects.create(user=self.user, recipe=self.recipe)
+        ids = [self.recipe.pk, self.other_recipe.pk, 999999]
+        response = self.client.post(
+            '/api/recipes/favorite/', {'ids': ids}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'], [
+            {'id': self.recipe.pk, 'status': 'exists'},
+            {'id': self.other_recipe.pk, 'status': 'created'},
+            {'id': 999999, 'status': 'not_found'},
+        ])
+        self.assert_no_drift()
+        response = self.client.delete(
+            '/api/recipes/favorite/', {'ids': ids}, format='json'
+        )
+        self.assertEqual(response.json()['results'], [
+            {'id': self.recipe.pk, 'status': 'deleted'},
+            {'id': self.other_recipe.pk, 'status': 'deleted'},
+            {'id': 999999, 'status': 'absent'},
+        ])
+        self.assertFalse(Favorite.objects.exists())
+        self.assert_no_drift()
+
+    def test_batch_subscribe(self):
+        ids = [self.user.pk, self.author.pk]
+        response = self.client.post(
+            '/api/users/subscribe/', {'ids': ids}, format='json'
+        )
+        self.assertEqual(response.json()['results'], [
+            {'id': self.user.pk, 'status': 'self'},
+            {'id': self.author.pk, 'status': 'created'},
+        ])
+        self.author.refresh_from_db()
+        self.assertEqual(self.author.subscribers_count, 1)
+        response = self.client.delete(
+            '/api/users/subscribe/', {'ids': ids}, format='json'
+        )
+        self.assertEqual(response.json()['results'], [
+            {'id': self.user.pk, 'status': 'absent'},
+            {'id': self.author.pk, 'status': 'deleted'},
+        ])
+        self.assert_no_drift()
+
+    def test_batch_invalid_ids(self):
+        for ids in ([], ['1'], [0], None, list(range(1, 102))):
+            with self.subTest(ids=ids):
+                response = self.client.post(
+                    '/api/recipes/favorite/', {'ids': ids}, format='json'
+                )
+                self.assertEqual(response.status_code, 400)
+
+
+@skipUnless(
+    connection.vendor == 'postgresql',
+    'Параллельные запросы проверяем только на PostgreSQL'
+)
+@override_settings(CACHES=CACHES)
+class ConcurrentLinkToggleTests(TransactionTestCase):
+    THREADS = 8
+
+    def setUp(self):
+        self.user = create_user(1)
+        self.recipe = create_recipe(create_user(2), 1)
+        # Токен заранее, чтобы потоки не создавали его наперегонки.
+        Token.objects.create(user=self.user)
+
+    def hit(self, method, url):
+        barrier = threading.Barrier(self.THREADS)
+        codes = []
+
+        def request():
+            client = authorized_client(self.user)
+            barrier.wait()
+            try:
+                codes.append(getattr(client, method)(url).status_code)
+            finally:
+                connections.close_all()
+
+        threads = [
+            threading.Thread(target=request) for _ in range(self.THREADS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sorted(codes)
+
+    def test_concurrent_toggle(self):
+        url = f'/api/recipes/{self.recipe.pk}/favorite/'
+        self.assertEqual(
+            self.hit('post', url), [201] + [400] * (self.THREADS - 1)
+        )
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.favorites_count, 1)
+        self.assertEqual(
+            self.hit('delete', url), [204] + [404] * (self.THREADS - 1)
+        )
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.favorites_count, 0)
+        self.assertEqual(recount(dry_run=True), NO_DRIFT)
+
+
+@override_settings(CACHES=CACHES)
+class VersionTests(TestCase):
+    def test_bumped_after_commit(self):
+        for name, create in (
+            ('ingredients', lambda: Ingredient.objects.create(
+                name='соль', measurement_unit='г'
+            )),
+            ('tags', lambda: Tag.objects.create(
+                name='Ужин', color='#8775D2', slug='dinner'
+            )),
+        ):
+            with self.subTest(name=name):
+                version = get_version(name)
+                with self.captureOnCommitCallbacks(execute=True):
+                    create()
+                    self.assertEqual(get_version(name), version)
+                self.assertGreater(get_version(name), version)
+
+    def test_recipes_version_on_user_save(self):
+        author = create_user(1)
+        create_recipe(author, 1)
+        reader = create_user(2)
+        for user, field, value, bumped in (
+            (author, 'last_login', datetime.now(timezone.utc), False),
+            (author, 'first_name', 'Новое имя', True),
+            (reader, 'first_name', 'Новое имя', False),
+        ):
+            with self.subTest(user=user.username, field=field):
+                version = get_version('recipes')
+                setattr(user, field, value)
+                with self.captureOnCommitCallbacks(execute=True):
+                    user.save()
+                self.assertEqual(get_version('recipes') != version, bumped)
+        version = get_version('recipes')
+        with self.captureOnCommitCallbacks(execute=True):
+            create_user(3)
+        self.assertEqual(get_version('recipes'), version)
+
+    def test_list_not_cached_before_commit(self):
+        client = APIClient()
+        before = client.get('/api/tags/')
+        with self.captureOnCommitCallbacks(execute=True):
+            Tag.objects.create(name='Ужин', color='#8775D2', slug='dinner')
+            during = client.get('/api/tags/')
+            self.assertEqual(during['ETag'], before['ETag'])
+        after = client.get('/api/tags/', HTTP_IF_NONE_MATCH=before['ETag'])
+        self.assertEqual(after.status_code, 200)
+        self.assertNotEqual(after['ETag'], before['ETag'])
+        self.assertEqual(
+            [tag['slug'] for tag in after.json()], ['dinner']
+        )
+
+
+@override_settings(CACHES=CACHES, SLOW_QUERY_FLUSH_INTERVAL=0)
+class SlowQueryFlushTests(TestCase):
+    def test_flushed_at_request_end(self):
+        store.flush()
+        store.record('test', 'SELECT 1', 500.0)
+        self.addCleanup(store._entries.pop, ('test', 'SELECT ?'))
+        self.assertNotIn('test', [
+            entry['label'] for entry in cache.get(store.key)
+        ])
+        APIClient().get('/api/tags/')
+        self.assertIn('test', [
+            entry['label'] for entry in cache.get(store.key)
+        ])
+
+
+@override_settings(CACHES=CACHES, METRICS_TOKEN='secret')
+class MetricsAccessTests(TestCase):
+    URL = '/api/internal/metrics/'
+
+    def get(self, **extra):
+        return APIClient().get(self.URL, REMOTE_ADDR='172.18.0.5', **extra)
+
+    def test_internal_ip(self):
+        self.assertEqual(APIClient().get(self.URL).status_code, 200)
+
+    def test_token(self):
+        for header, status in (
+            (None, 403),
+            ('Bearer wrong', 403),
+            ('Token secret', 403),
+            ('Bearer secret', 200),
+        ):
+            with self.subTest(header=header):
+                extra = {'HTTP_AUTHORIZATION': header} if header else {}
+                self.assertEqual(self.get(**extra).status_code, status)
+
+    @override_settings(METRICS_TOKEN='')
+    def test_empty_token(self):
+        self.assertEqual(
+            self.get(HTTP_AUTHORIZATION='Bearer ').status_code, 403
+        )
+
+
+@override_settings(CACHES=CACHES, RECIPE_FEED_STATS_INTERVAL=3600)
+class FeedCacheStatsTests(TestCase):
+    def test_counted_in_process(self):
+        before = feed_cache_stats()
+        for _ in range(3):
+            APIClient().get('/api/recipes/')
+        self.assertEqual(cache.get('recipes-feed:hits', 0), before['hits'])
+        self.assertEqual(feed_cache_stats(), {
+            'hits': before['hits'] + 2, 'misses': before['misses'] + 1
+        })
+
+
+class SimilarRecipesIndexTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.ingredients = [
+            Ingredient.objects.create(name=f'ингредиент {number}',
+                                      measurement_unit='г')
+            for number in range(3)
+        ]
+        author = create_user(1)
+        cls.recipes = [create_recipe(author, number) for number in range(3)]
+        for recipe in cls.recipes:
+            IngredientInRecipe.objects.bulk_create(
+                IngredientInRecipe(
+                    recipe=recipe, ingredient=ingredient, amount=1
+                ) for ingredient in cls.ingredients
+            )
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'similar_recipes.npz')
+        override = self.settings(SIMILAR_RECIPES_INDEX=self.path)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def similar(self):
+        return [pk for pk, _ in similar_recipes.similar(
+            self.recipes[0].pk,
+            [ingredient.pk for ingredient in self.ingredients],
+            10
+        )]
+
+    def test_delta_does_not_reload_base(self):
+        IngredientInRecipe.objects.filter(recipe=self.recipes[2]).delete()
+        rebuild_similar_recipes()
+        with mock.patch('recipes.similarity.read', wraps=read) as reader:
+            self.assertEqual(self.similar(), [self.recipes[1].pk])
+            IngredientInRecipe.objects.bulk_create(
+                IngredientInRecipe(
+                    recipe=self.recipes[2], ingredient=ingredient, amount=1
+                ) for ingredient in self.ingredients
+            )
+            update_similar_recipes([self.recipes[2].pk])
+            self.assertEqual(
+                self.similar(), [self.recipes[1].pk, self.recipes[2].pk]
+            )
+        self.assertEqual(
+            [call.args[0] for call in reader.call_args_list].count(self.path),
+            1
+        )
+
+
+class RecipeImageUploadTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.upload_dir = os.path.join(directory, 'uploads')
+        os.mkdir(self.upload_dir)
+        override = self.settings(
+            MEDIA_ROOT=os.path.join(directory, 'media'),
+            FILE_UPLOAD_TEMP_DIR=self.upload_dir
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        author = create_user(1)
+        self.url = f'/api/recipes/{create_recipe(author, 1).pk}/image/'
+        self.client = authorized_client(author)
+
+    def test_raw_upload_closes_temp_file(self):
+        handlers = []
+
+        def handler(request):
+            handlers.append(TemporaryFileUploadHandler(request))
+            return handlers[-1]
+
+        image = BytesIO()
+        Image.new('RGB', (4, 4)).save(image, 'PNG')
+        for body, status in ((image.getvalue(), 200), (b'not an image', 400)):
+            with self.subTest(status=status), mock.patch(
+                'api.views.TemporaryFileUploadHandler', side_effect=handler
+            ):
+                response = self.client.put(
+                    self.url, body, content_type='image/png'
+                )
+                self.assertEqual(response.status_code, status)
+                self.assertTrue(handlers[-1].file.closed)
+                self.assertEqual(os.listdir(self.upload_dir), [])
+
+
+class FastJSONRendererTests(TestCase):
+    def assert_same_json(self, data):
+        self.assertEqual(
+            FastJSONRenderer().render(data), JSONRenderer().render(data)
+        )
+
+    def test_matches_json_renderer(self):
+        for data in (
+            {'id': 1, 'name': 'Рецепт', 'tags': [], 'image': None},
+            {1: 'целый ключ', 'nested': {2: [3.5, True]}},
+            {'amount': Decimal('1.50')},
+            {'detail': gettext_lazy('Not found.')},
+            {'ids': {7}},
+            {'created': datetime(2024, 1, 2, 3, 4, 5, 678901, timezone.utc)},
+            {'day': date(2024, 1, 2), 'uuid': uuid.UUID(int=1)},
+            {'text': 'строка\u2028и\u2029абзац'},
+            {'big': 2 ** 70},
+        ):
+            with self.subTest(data=data):
+                self.assert_same_json(data)
+
+
+@override_settings(CACHES=CACHES)
+class RecipeReaderTests(TestCase):
+    PATHS = (
+        '/api/recipes/?limit=50',
+        '/api/recipes/?cursor=&limit=50',
+        '/api/recipes/?tags=breakfast&limit=50',
+        '/api/recipes/?search=рецепт&limit=50',
+    )
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.reader = create_user(1)
+        authors = [create_user(2), create_user(3)]
+        tags = [
+            Tag.objects.create(name='Завтрак', color='#E26C2D',
+                               slug='breakfast'),
+            Tag.objects.create(name='Обед', color='#49B64E', slug='lunch'),
+        ]
+        ingredients = [
+            Ingredient.objects.create(name=f'ингредиент {number}',
+                                      measurement_unit='г')
+            for number in range(3)
+        ]
+        for number in range(6):
+            recipe = create_recipe(authors[number % 2], number)
+            recipe.tags.set(tags[:number % 2 + 1])
+            IngredientInRecipe.objects.bulk_create(
+                IngredientInRecipe(
+                    recipe=recipe, ingredient=ingredient, amount=number + 1
+                ) for ingredient in ingredients[:number % 3 + 1]
+            )
+            if number % 2:
+                Favorite.objects.create(user=cls.reader, recipe=recipe)
+            if number % 3:
+                ShoppingCart.objects.create(user=cls.reader, recipe=recipe)
+        Subscription.objects.create(user=cls.reader, author=authors[0])
+        recount()
+        update_search_index()
+
+    def recipe_view(self, path, user):
+        request = Request(APIRequestFactory().get(path))
+        request.user = user
+        return RecipeViewSet(request=request, action='list', format_kwarg=None)
+
+    def serializer_page(self, path, user):
+        view = self.recipe_view(path, user)
+        page = view.paginate_queryset(
+            view.filter_queryset(view.get_queryset())
+        )
+        return JSONRenderer().render(RecipeReadSerializer(
+            page, many=True, context={'request': view.request}
+        ).data)
+
+    def fast_page(self, path, user):
+        view = self.recipe_view(path, user)
+        page = view.paginate_queryset(
+            recipe_values(view.filter_queryset(view.get_queryset()))
+        )
+        return FastJSONRenderer().render(build_recipes(page, view.request))
+
+    def test_matches_serializer(self):
+        for user in (AnonymousUser(), self.reader):
+            for path in self.PATHS:
+                with self.subTest(path=path, user=user):
+                    expected = self.serializer_page(path, user)
+                    self.assertNotEqual(expected, b'[]')
+                    self.assertEqual(self.fast_page(path, user), expected)
@@ -0,0 +1,52 @@
+import mimetypes
+
+import filetype
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import FileUploadParser
+
+
+class ImageUploadParser(FileUploadParser):
+    media_type = 'image/*'
+
+    def get_filename(self, stream, media_type, parser_context):
+        filename = super().get_filename(stream, media_type, parser_context)
+        if filename:
+            return filename
+        content_type = parser_context['request'].content_type.split(';')[0]
+        return f'image{mimetypes.guess_extension(content_type) or ""}'
+
+
+class LimitedImageUploadHandler(FileUploadHandler):
+    too_large_message = 'Файл больше {} МБ'
+    wrong_type_message = 'Допустимы только изображения: {}'
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.received = 0
+        if (self.content_length
+                and self.content_length > settings.RECIPE_IMAGE_MAX_SIZE):
+            self.fail(self.too_large_message.format(
+                settings.RECIPE_IMAGE_MAX_SIZE // 2 ** 20
+            ))
+
+    def receive_data_chunk(self, raw_data, start):
+        if start == 0:
+            kind = filetype.guess(raw_data)
+            if kind is None or kind.mime not in settings.RECIPE_IMAGE_TYPES:
+                self.fail(self.wrong_type_message.format(
+                    ', '.join(settings.RECIPE_IMAGE_TYPES)
+                ))
+        self.received += len(raw_data)
+        if self.received > settings.RECIPE_IMAGE_MAX_SIZE:
+            self.fail(self.too_large_message.format(
+                settings.RECIPE_IMAGE_MAX_SIZE // 2 ** 20
+            ))
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+    def fail(self, message):
+        raise ValidationError({'image': [message]})
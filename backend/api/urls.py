@@ -5,7 +5,8 @@ from .views import (
     FoodgramUserViewSet,
     RecipeViewSet,
     TagViewSet,
-    IngredientsViewSet
+    IngredientsViewSet,
+    MetricsView
 )
 
 app_name = 'api'
@@ -17,6 +18,7 @@ router.register(r'tags', TagViewSet, basename='tag')
 router.register(r'ingredients', IngredientsViewSet, basename='ingredient')
 
 urlpatterns = [
+    path('internal/metrics/', MetricsView.as_view(), name='metrics'),
     path('', include(router.urls)),
     path('', include('djoser.urls')),
     path('auth/', include('djoser.urls.authtoken')),
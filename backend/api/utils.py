@@ -1,41 +1,263 @@
+import csv
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import Prefetch, prefetch_related_objects
+from django.http import Http404, HttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
 
+from recipes.images import derivative_names, derivatives_ready
+from recipes.following import limit_recipes_per_author
+from recipes.links import LINK_FIELDS, delete_links, links_changed
 from recipes.models import Recipe, Subscription
+from recipes.versions import get_version
+
+from .metrics import measure_render
+
+
+def get_subscribed_author_ids(request):
+    if not hasattr(request, '_subscribed_author_ids'):
+        request._subscribed_author_ids = set(
+            Subscription.objects.filter(
+                user=request.user
+            ).values_list('author_id', flat=True)
+        )
+    return request._subscribed_author_ids
+
+
+def media_url(name, request=None):
+    url = default_storage.url(name)
+    if request is not None:
+        url = request.build_absolute_uri(url)
+    return url
+
+
+def derivative_urls(name, request=None):
+    if not name or not derivatives_ready(name):
+        return None
+    return {
+        size: {
+            extension: media_url(derivative, request)
+            for extension, derivative in formats.items()
+        } for size, formats in derivative_names(name).items()
+    }
+
+
+def parse_field_names(value):
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+
+def get_sparse_fields(request, available):
+    fields = parse_field_names(request.query_params.get('fields', ''))
+    omit = parse_field_names(request.query_params.get('omit', ''))
+    if not fields and not omit:
+        return None
+    unknown = (fields | omit) - set(available)
+    if unknown:
+        raise serializers.ValidationError(
+            {'fields': 'Неизвестные поля: ' + ', '.join(sorted(unknown))}
+        )
+    return [
+        name for name in available
+        if (not fields or name in fields) and name not in omit
+    ]
+
+
+MAX_BATCH_SIZE = 100
+
+
+def get_batch_ids(request):
+    ids = request.data.get('ids') if isinstance(request.data, dict) else None
+    valid = isinstance(ids, list) and 0 < len(ids) <= MAX_BATCH_SIZE and all(
+        type(pk) is int and pk > 0 for pk in ids
+    )
+    if not valid:
+        raise serializers.ValidationError({'ids': (
+            f'Нужен непустой список не более чем из {MAX_BATCH_SIZE} '
+            f'положительных целых чисел'
+        )})
+    return list(dict.fromkeys(ids))
+
+
+def get_recipes_limit(request):
+    limit = request.query_params.get('recipes_limit')
+    if limit is None:
+        return None
+    if not limit.isdigit() or int(limit) < 1:
+        raise serializers.ValidationError(
+            {'recipes_limit': 'Должно быть целым положительным числом'}
+        )
+    return int(limit)
+
+
+def prefetch_recipes_preview(authors, limit):
+    recipes = Recipe.objects.filter(author__in=authors)
+    if limit is not None:
+        recipes = limit_recipes_per_author(recipes, limit)
+    prefetch_related_objects(
+        authors,
+        Prefetch('recipes', queryset=recipes, to_attr='recipes_preview')
+    )
+
+
+class Echo:
+    def write(self, value):
+        return value
+
+
+def shopping_list_rows(ingredients, file_format):
+    if file_format == 'csv':
+        writer = csv.writer(Echo())
+        yield writer.writerow(
+            ('Ингредиент', 'Единица измерения', 'Количество')
+        )
+        for ingredient in ingredients:
+            yield writer.writerow((
+                ingredient['ingredient__name'],
+                ingredient['ingredient__measurement_unit'],
+                ingredient['total'],
+            ))
+        return
+    yield 'Список покупок:\n'
+    for ingredient in ingredients:
+        yield (
+            f'{ingredient["ingredient__name"]} '
+            f'({ingredient["ingredient__measurement_unit"]}) — '
+            f'{ingredient["total"]}\n'
+        )
+
+
+class VersionedListMixin:
+    version_name = None
+    max_rendered = 256
+    _rendered = OrderedDict()
+    _rendered_lock = threading.Lock()
+
+    def get_list_data(self, request):
+        raise NotImplementedError
+
+    def get_list_variant(self, request):
+        return ''
+
+    def render_list(self, request, version, variant):
+        # Сигналы меняют версию только после коммита, поэтому под новой
+        # версией (и её ETag) не окажутся строки до изменения.
+        key = (self.version_name, version, variant)
+        with self._rendered_lock:
+            body = self._rendered.get(key)
+            if body is not None:
+                self._rendered.move_to_end(key)
+        if body is None:
+            data = self.get_list_data(request)
+            with measure_render():
+                body = JSONRenderer().render(data)
+            with self._rendered_lock:
+                self._rendered[key] = body
+                while len(self._rendered) > self.max_rendered:
+                    self._rendered.popitem(last=False)
+        return HttpResponse(body, content_type='application/json')
+
+    def list(self, request, *args, **kwargs):
+        version = get_version(self.version_name)
+        variant = self.get_list_variant(request)
+        etag = '"{}"'.format(hashlib.md5(
+            f'{self.version_name}:{version}:{variant}'.encode()
+        ).hexdigest())
+        last_modified = version // 10 ** 9
+        response = get_conditional_response(
+            request._request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            if isinstance(request.accepted_renderer, JSONRenderer):
+                response = self.render_list(request, version, variant)
+            else:
+                response = Response(self.get_list_data(request))
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        response['Cache-Control'] = 'no-cache'
+        return response
 
 
 class CreateDeleteMixin:
     @staticmethod
-    def create_object(request, pk, serializer_in, serializer_out, model):
-        user = request.user.id
+    def create_object(request, pk, serializer_out, model, link_model):
+        user = request.user
         obj = get_object_or_404(model, id=pk)
-        data_recipe = {'user': user, 'recipe': obj.id}
-        data_subscribe = {'user': user, 'author': obj.id}
-
-        if model is Recipe:
-            serializer = serializer_in(data=data_recipe)
-        else:
-            serializer = serializer_in(data=data_subscribe)
-
-        serializer.is_valid(raise_exception=True)
-        serializer.save()
-        serializer_to_response = serializer_out(
-            obj,
-            context={'request': request}
-        )
-        return serializer_to_response
+        if link_model is Subscription and obj.pk == user.pk:
+            raise serializers.ValidationError('Нельзя подписаться на себя')
+        # Повторы отсекает уникальное ограничение в базе, а не проверка
+        # заранее: иначе два одновременных запроса оба пройдут проверку.
+        try:
+            with transaction.atomic():
+                link_model.objects.create(
+                    user=user, **{LINK_FIELDS[link_model]: obj}
+                )
+        except IntegrityError:
+            if link_model is Subscription:
+                raise serializers.ValidationError(
+                    'Дважды на одного пользователя нельзя подписаться'
+                )
+            raise serializers.ValidationError(
+                f'Такой рецепт уже есть в '
+                f'{link_model._meta.verbose_name_plural}'
+            )
+        return serializer_out(obj, context={'request': request})
 
     @staticmethod
-    def delete_object(request, pk, model_object, model_for_delete_object):
-        user = request.user
-        obj_recipe = get_object_or_404(model_object, id=pk)
-        obj_subscription = get_object_or_404(model_object, id=pk)
+    def delete_object(request, pk, link_model):
+        # Один DELETE: удалённые строки заменяют поиск объекта.
+        if not delete_links(link_model, request.user.pk, [pk]):
+            raise Http404
 
-        if model_for_delete_object is Subscription:
-            obj = get_object_or_404(
-                model_for_delete_object, user=user, author=obj_subscription
-            )
-        else:
-            obj = get_object_or_404(
-                model_for_delete_object, user=user, recipe=obj_recipe
+
+class BatchMixin:
+    @staticmethod
+    def batch_response(outcomes):
+        return Response({'results': [
+            {'id': pk, 'status': outcome} for pk, outcome in outcomes.items()
+        ]})
+
+    def batch_create(self, request, model, link_model, field):
+        user = request.user
+        ids = get_batch_ids(request)
+        found = set(
+            model.objects.filter(pk__in=ids).values_list('pk', flat=True)
+        )
+        linked = set(link_model.objects.filter(
+            user=user, **{f'{field}_id__in': found}
+        ).values_list(f'{field}_id', flat=True))
+        outcomes = {}
+        for pk in ids:
+            if pk not in found:
+                outcomes[pk] = 'not_found'
+            elif pk in linked:
+                outcomes[pk] = 'exists'
+            elif link_model is Subscription and pk == user.pk:
+                outcomes[pk] = 'self'
+            else:
+                outcomes[pk] = 'created'
+        created = [pk for pk, outcome in outcomes.items()
+                   if outcome == 'created']
+        with transaction.atomic():
+            link_model.objects.bulk_create(
+                [link_model(user=user, **{f'{field}_id': pk})
+                 for pk in created],
+                ignore_conflicts=True
             )
-        obj.delete()
+            links_changed(link_model, user.pk, created, added=True)
+        return self.batch_response(outcomes)
+
+    def batch_delete(self, request, model, link_model, field):
+        ids = get_batch_ids(request)
+        deleted = set(delete_links(link_model, request.user.pk, ids))
+        return self.batch_response({
+            pk: 'deleted' if pk in deleted else 'absent' for pk in ids
+        })
@@ -1,119 +1,332 @@
+from uuid import uuid4
+
 from django.contrib.auth import get_user_model
-from django.db.models import Sum, Exists, OuterRef
-from django.http import HttpResponse, FileResponse
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.db.models import Sum, Exists, OuterRef, Prefetch, Value
+from django.http import Http404, HttpResponse
+from django.shortcuts import get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
 from djoser.views import UserViewSet
-from rest_framework import viewsets, status, filters
+from rest_framework import viewsets, status
 from rest_framework.decorators import action
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.parsers import MultiPartParser
+from rest_framework.renderers import JSONRenderer
 from rest_framework.permissions import (
     IsAuthenticated,
     SAFE_METHODS,
     IsAuthenticatedOrReadOnly
 )
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
 from recipes.models import (
     Recipe,
     Tag,
     Ingredient,
+    IngredientInRecipe,
     Subscription,
     ShoppingCart,
-    Favorite
+    Favorite,
+    FeedItem
 )
-from .permissions import IsOwnerOrReadOnly
+from recipes.following import fan_out_on_write
+from recipes.similarity import similar_recipes
+from .async_views import AsyncReadMixin
+from .metrics import CONTENT_TYPE, registry
+from .pagination import KeysetPagination, LimitPageNumberPagination
+from .permissions import HasMetricsToken, IsInternalIP, IsOwnerOrReadOnly
+from .recipe_reader import build_recipes, recipe_values
+from .renderers import CSVRenderer, PlainTextRenderer
 from .serializers import (
     UserSerializer,
     TagSerializer,
     IngredientSerializer,
+    SparseFieldsMixin,
     SubscriptionReadSerializer,
-    SubscriptionSerializer,
     RecipeFavoriteSerializer,
-    ShoppingCartSerializer,
-    FavoriteSerializer,
+    RecipeImageSerializer,
     RecipeReadSerializer,
     RecipeWriteSerializer
 )
-from .utils import CreateDeleteMixin
+from .uploads import ImageUploadParser, LimitedImageUploadHandler
+from .utils import (
+    BatchMixin,
+    CreateDeleteMixin,
+    VersionedListMixin,
+    get_recipes_limit,
+    get_sparse_fields,
+    prefetch_recipes_preview,
+    shopping_list_rows
+)
+from .feed_cache import cache_feed, feed_cache_key, get_cached_feed
 from .filters import RecipeFilter
+from .ingredient_index import ingredient_index, normalize
 
 User = get_user_model()
 
 
-class FoodgramUserViewSet(UserViewSet, CreateDeleteMixin):
+class FoodgramUserViewSet(UserViewSet, CreateDeleteMixin, BatchMixin):
     queryset = User.objects.all()
     serializer_class = UserSerializer
 
+    def get_sparse_fields(self):
+        # Ничего не кэшируем: browsable API строит форму POST, подменяя
+        # метод запроса, и для неё нужен другой сериализатор.
+        serializer_class = self.get_serializer_class()
+        if self.request.method not in SAFE_METHODS or not issubclass(
+            serializer_class, SparseFieldsMixin
+        ):
+            return None
+        return get_sparse_fields(self.request, serializer_class.Meta.fields)
+
+    def get_serializer(self, *args, **kwargs):
+        fields = self.get_sparse_fields()
+        if fields is not None:
+            kwargs['fields'] = fields
+        return super().get_serializer(*args, **kwargs)
+
+    def get_serializer_class(self):
+        if self.action == 'subscriptions':
+            return SubscriptionReadSerializer
+        return super().get_serializer_class()
+
+    def get_queryset(self):
+        users = super().get_queryset()
+        fields = self.get_sparse_fields() or UserSerializer.Meta.fields
+        if (self.request.user.is_authenticated
+                and 'is_subscribed' in fields):
+            users = users.annotate(
+                is_subscribed=Exists(
+                    Subscription.objects.filter(
+                        user=self.request.user,
+                        author_id=OuterRef('pk'),
+                    )
+                )
+            )
+        return users
+
     @action(detail=True, methods=['post'])
     def subscribe(self, request, id):
+        get_recipes_limit(request)
         serializer = self.create_object(
             request,
             id,
-            SubscriptionSerializer,
             SubscriptionReadSerializer,
-            User
+            User,
+            Subscription
         )
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     @subscribe.mapping.delete
     def unsubscribe(self, request, id):
-        self.delete_object(request, id, User, Subscription)
+        self.delete_object(request, id, Subscription)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(
+        detail=False,
+        methods=['post'],
+        url_path='subscribe',
+        permission_classes=[IsAuthenticated]
+    )
+    def subscribe_batch(self, request):
+        return self.batch_create(request, User, Subscription, 'author')
+
+    @subscribe_batch.mapping.delete
+    def unsubscribe_batch(self, request):
+        return self.batch_delete(request, User, Subscription, 'author')
+
     @action(detail=False, methods=['get'])
     def subscriptions(self, request):
         user = request.user
-        authors = User.objects.filter(subscribing__user=user)
+        recipes_limit = get_recipes_limit(request)
+        authors = User.objects.filter(
+            subscribing__user=user
+        ).annotate(is_subscribed=Value(True))
+        fields = self.get_sparse_fields()
 
         paged_queryset = self.paginate_queryset(authors)
+        if fields is None or 'recipes' in fields:
+            prefetch_recipes_preview(paged_queryset, recipes_limit)
         serializer = SubscriptionReadSerializer(
             paged_queryset,
             context={'request': request},
-            many=True
+            many=True,
+            fields=fields
         )
         return self.get_paginated_response(serializer.data)
 
 
-class IngredientsViewSet(viewsets.ReadOnlyModelViewSet):
+class IngredientsViewSet(
+    AsyncReadMixin,
+    VersionedListMixin,
+    viewsets.ReadOnlyModelViewSet
+):
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
-    filter_backends = [filters.SearchFilter]
-    search_fields = ('^name',)
     pagination_class = None
+    version_name = 'ingredients'
+
+    def get_list_variant(self, request):
+        return normalize(request.query_params.get('name', ''))
 
+    def get_list_data(self, request):
+        return ingredient_index.search(self.get_list_variant(request))
 
-class TagViewSet(viewsets.ModelViewSet):
+
+class TagViewSet(AsyncReadMixin, VersionedListMixin, viewsets.ModelViewSet):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     pagination_class = None
+    version_name = 'tags'
+
+    def get_list_data(self, request):
+        return self.get_serializer(self.get_queryset(), many=True).data
 
 
-class RecipeViewSet(viewsets.ModelViewSet, CreateDeleteMixin):
-    pagination_class = PageNumberPagination
+class RecipeViewSet(
+    AsyncReadMixin,
+    viewsets.ModelViewSet,
+    CreateDeleteMixin,
+    BatchMixin
+):
+    pagination_class = LimitPageNumberPagination
     permission_classes = (IsOwnerOrReadOnly, IsAuthenticatedOrReadOnly)
     filter_backends = (DjangoFilterBackend,)
     filterset_class = RecipeFilter
 
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            params = self.request.query_params
+            if (self.action == 'feed'
+                    or KeysetPagination.cursor_query_param in params):
+                self._paginator = KeysetPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+    def get_sparse_fields(self):
+        # Ничего не кэшируем: browsable API строит форму POST, подменяя
+        # метод запроса, и для неё нужен другой сериализатор.
+        serializer_class = self.get_serializer_class()
+        if self.request.method not in SAFE_METHODS or not issubclass(
+            serializer_class, SparseFieldsMixin
+        ):
+            return None
+        return get_sparse_fields(self.request, serializer_class.Meta.fields)
+
+    def get_serializer(self, *args, **kwargs):
+        fields = self.get_sparse_fields()
+        if fields is not None:
+            kwargs['fields'] = fields
+        return super().get_serializer(*args, **kwargs)
+
     def get_queryset(self):
-        recipes = Recipe.objects.prefetch_related(
-            'ingredient__ingredient', 'tags'
-        ).all()
+        fields = self.get_sparse_fields() or RecipeReadSerializer.Meta.fields
+        recipes = Recipe.objects.all()
+        if 'author' in fields:
+            recipes = recipes.select_related('author')
+        if 'ingredients' in fields:
+            recipes = recipes.prefetch_related('ingredient__ingredient')
+        if 'tags' in fields:
+            recipes = recipes.prefetch_related(
+                Prefetch('tags', queryset=Tag.objects.order_by('id'))
+            )
+        if 'text' not in fields:
+            recipes = recipes.defer('text')
         if self.request.user.is_authenticated:
-            recipes = recipes.annotate(
-                is_favorited=Exists(
-                    Favorite.objects.filter(
-                        user=self.request.user,
-                        recipe_id=OuterRef('pk'),
-                    )
+            flags = {
+                'is_favorited': Favorite,
+                'is_in_shopping_cart': ShoppingCart,
+            }
+            recipes = recipes.annotate(**{
+                name: Exists(model.objects.filter(
+                    user=self.request.user,
+                    recipe_id=OuterRef('pk'),
+                )) for name, model in flags.items() if name in fields
+            })
+        return recipes
+
+    def list(self, request, *args, **kwargs):
+        if (request.user.is_authenticated
+                or not isinstance(request.accepted_renderer, JSONRenderer)):
+            return self.list_recipes(request)
+        key = feed_cache_key(request)
+        body = get_cached_feed(key)
+        if body is not None:
+            response = HttpResponse(body, content_type='application/json')
+            response['X-Cache'] = 'HIT'
+            return response
+        response = self.list_recipes(request)
+        if response.status_code == status.HTTP_200_OK:
+            body = request.accepted_renderer.render(response.data)
+            cache_feed(key, body)
+            response = HttpResponse(body, content_type='application/json')
+        response['X-Cache'] = 'MISS'
+        return response
+
+    def list_recipes(self, request):
+        fields = self.get_sparse_fields()
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(recipe_values(queryset, fields))
+        return self.get_paginated_response(
+            build_recipes(page, request, fields)
+        )
+
+    @action(detail=True)
+    def similar(self, request, pk):
+        if not str(pk).isdigit():
+            raise Http404
+        ingredients = list(IngredientInRecipe.objects.filter(
+            recipe_id=pk
+        ).values_list('ingredient_id', flat=True))
+        if not ingredients:
+            get_object_or_404(Recipe, pk=pk)
+        matches = similar_recipes.similar(
+            int(pk),
+            ingredients,
+            self.pagination_class().get_page_size(request)
+        )
+        fields = self.get_sparse_fields()
+        rows = {row['id']: row for row in recipe_values(
+            self.get_queryset().filter(pk__in=[pk for pk, _ in matches]),
+            fields
+        )}
+        matches = [(pk, score) for pk, score in matches if pk in rows]
+        data = build_recipes([rows[pk] for pk, _ in matches], request, fields)
+        for recipe, (_, score) in zip(data, matches):
+            recipe['similarity'] = round(score, 3)
+        return Response(data)
+
+    @action(detail=False, permission_classes=[IsAuthenticated])
+    def feed(self, request):
+        fields = self.get_sparse_fields()
+        if fan_out_on_write():
+            items = self.paginate_queryset(
+                FeedItem.objects.filter(user=request.user).only(
+                    'id', 'recipe_id', 'pub_date'
+                )
+            )
+            rows = {row['id']: row for row in recipe_values(
+                self.get_queryset().filter(
+                    pk__in=[item.recipe_id for item in items]
                 ),
-                is_in_shopping_cart=Exists(
-                    ShoppingCart.objects.filter(
-                        user=self.request.user,
-                        recipe_id=OuterRef('pk'),
-                    )
+                fields
+            )}
+            page = [rows[item.recipe_id] for item in items
+                    if item.recipe_id in rows]
+        else:
+            page = self.paginate_queryset(recipe_values(
+                self.get_queryset().filter(
+                    author__in=Subscription.objects.filter(
+                        user=request.user
+                    ).values('author_id')
                 ),
-            ).select_related('author')
-        return recipes
+                fields
+            ))
+        return self.get_paginated_response(
+            build_recipes(page, request, fields)
+        )
 
     def perform_create(self, serializer):
         return serializer.save(author=self.request.user)
@@ -123,20 +336,56 @@ class RecipeViewSet(viewsets.ModelViewSet, CreateDeleteMixin):
             return RecipeReadSerializer
         return RecipeWriteSerializer
 
+    @action(
+        detail=True,
+        methods=['put'],
+        parser_classes=[MultiPartParser, ImageUploadParser]
+    )
+    def image(self, request, pk):
+        recipe = self.get_object()
+        handlers = request._request.upload_handlers = [
+            LimitedImageUploadHandler(request),
+            TemporaryFileUploadHandler(request),
+        ]
+        try:
+            files = request.FILES
+            serializer = RecipeImageSerializer(data={
+                'image': files.get('image') or files.get('file')
+            })
+            serializer.is_valid(raise_exception=True)
+            upload = serializer.validated_data['image']
+            recipe.image.save(
+                f'{uuid4()}.{upload.image.format.lower()}',
+                upload,
+                save=False
+            )
+        finally:
+            # Django закрывает файлы только у multipart-запросов, временный
+            # файл тела image/* закрываем сами, в том числе при ошибке.
+            for handler in handlers:
+                if getattr(handler, 'file', None) is not None:
+                    handler.file.close()
+        recipe.save(update_fields=['image'])
+        serializer = RecipeReadSerializer(
+            recipe,
+            context=self.get_serializer_context()
+        )
+        return Response(serializer.data)
+
     @action(detail=True, methods=['post'])
     def favorite(self, request, pk):
         serializer = self.create_object(
             request,
             pk,
-            FavoriteSerializer,
             RecipeFavoriteSerializer,
-            Recipe
+            Recipe,
+            Favorite
         )
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     @favorite.mapping.delete
     def delete_favorite(self, request, pk):
-        self.delete_object(request, pk, Recipe, Favorite)
+        self.delete_object(request, pk, Favorite)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(detail=True, methods=['post'])
@@ -144,47 +393,68 @@ class RecipeViewSet(viewsets.ModelViewSet, CreateDeleteMixin):
         serializer = self.create_object(
             request,
             pk,
-            ShoppingCartSerializer,
             RecipeFavoriteSerializer,
-            Recipe
+            Recipe,
+            ShoppingCart
         )
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     @shopping_cart.mapping.delete
     def delete_shopping_cart(self, request, pk):
-        self.delete_object(request, pk, Recipe, ShoppingCart)
+        self.delete_object(request, pk, ShoppingCart)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(detail=False, methods=['post'], url_path='favorite')
+    def favorite_batch(self, request):
+        return self.batch_create(request, Recipe, Favorite, 'recipe')
+
+    @favorite_batch.mapping.delete
+    def delete_favorite_batch(self, request):
+        return self.batch_delete(request, Recipe, Favorite, 'recipe')
+
+    @action(detail=False, methods=['post'], url_path='shopping_cart')
+    def shopping_cart_batch(self, request):
+        return self.batch_create(request, Recipe, ShoppingCart, 'recipe')
+
+    @shopping_cart_batch.mapping.delete
+    def delete_shopping_cart_batch(self, request):
+        return self.batch_delete(request, Recipe, ShoppingCart, 'recipe')
+
     @action(
         detail=False,
         methods=['get'],
-        permission_classes=[IsAuthenticated]
+        permission_classes=[IsAuthenticated],
+        renderer_classes=[PlainTextRenderer, CSVRenderer]
     )
     def download_shopping_cart(self, request):
-        ingredients = ShoppingCart.objects.filter(
-            user=request.user
-        ).values_list(
-            'recipe_id__ingredients__name',
-            'recipe_id__ingredients__measurement_unit',
-            Sum('recipe_id__ingredients__ingredient__amount'))
-        ingredients = set(ingredients)
-
-        shopping_list = ['Список покупок:']
-
-        for ingredient in ingredients:
-            shopping_list.append(
-                f'{ingredient[0]} '
-                f'({ingredient[1]})'
-                f'{ingredient[2]}'
-            )
-        content = '\n'.join(shopping_list)
-        response = HttpResponse(content, content_type='text/plain')
-        response[
-            'Content-Disposition'
-        ] = 'attachment; filename="shopping_list.txt"'
-
-        return FileResponse(
-            '\n'.join(shopping_list),
-            status=status.HTTP_200_OK,
-            content_type='text/plain',
+        ingredients = IngredientInRecipe.objects.filter(
+            recipe__cart__user=request.user
+        ).values(
+            'ingredient__name',
+            'ingredient__measurement_unit'
+        ).annotate(
+            total=Sum('amount')
+        ).order_by(
+            'ingredient__name',
+            'ingredient__measurement_unit'
+        )
+        renderer = request.accepted_renderer
+        # Строки собираем здесь, а не в потоковом ответе: под ASGI тело
+        # StreamingHttpResponse читается в событийном цикле, где ORM
+        # запрещён. Строк не больше, чем разных ингредиентов.
+        response = HttpResponse(
+            ''.join(shopping_list_rows(ingredients, renderer.format)),
+            content_type=f'{renderer.media_type}; charset={renderer.charset}'
+        )
+        response['Content-Disposition'] = (
+            f'attachment; filename="shopping_list.{renderer.format}"'
         )
+        return response
+
+
+class MetricsView(APIView):
+    authentication_classes = ()
+    permission_classes = (IsInternalIP | HasMetricsToken,)
+
+    def get(self, request):
+        return HttpResponse(registry.render(), content_type=CONTENT_TYPE)
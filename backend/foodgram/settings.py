@@ -22,6 +22,7 @@ INSTALLED_APPS = [
     'rest_framework',
     'rest_framework.authtoken',
     'djoser',
+    'django_filters',
     'djangoviz',
 
     'api',
@@ -30,6 +31,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -39,6 +41,22 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Статистика медленных запросов собирается через кэш по умолчанию и
+# требует общего для процессов бэкенда (см. CACHES).
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', 100))
+SLOW_QUERY_MAX_FINGERPRINTS = int(
+    os.getenv('SLOW_QUERY_MAX_FINGERPRINTS', 500)
+)
+SLOW_QUERY_FLUSH_INTERVAL = int(os.getenv('SLOW_QUERY_FLUSH_INTERVAL', 10))
+
+# Под ASGI (foodgram/asgi.py) вьюхи чтения работают в пуле потоков.
+ASYNC_READ_VIEWS = os.getenv('ASYNC_READ_VIEWS', 'False') == 'True'
+
+# /api/internal/ закрыт в nginx: метрики снимают напрямую с backend:8000
+# по адресу из INTERNAL_IPS или с заголовком «Authorization: Bearer».
+INTERNAL_IPS = os.getenv('INTERNAL_IPS', '127.0.0.1').split(',')
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
 ROOT_URLCONF = 'foodgram.urls'
 
 TEMPLATES = [
@@ -73,6 +91,39 @@ DATABASES = {
     }
 }
 
+# Версии кэшей, ETag справочников, лента и медленные запросы должны быть
+# общими для всех воркеров и команд manage.py, поэтому по умолчанию
+# кэш файловый, а не в памяти процесса. Для нескольких контейнеров
+# нужен общий том или Redis/Memcached через CACHE_BACKEND.
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND',
+            'django.core.cache.backends.filebased.FileBasedCache'
+        ),
+        'LOCATION': os.getenv(
+            'CACHE_LOCATION', os.path.join(BASE_DIR, 'cache')
+        ),
+    }
+}
+
+SEARCH_CONFIG = os.getenv('SEARCH_CONFIG', 'russian')
+
+RECIPE_FEED_CACHE_TIMEOUT = int(os.getenv('RECIPE_FEED_CACHE_TIMEOUT', 300))
+RECIPE_FEED_STATS_INTERVAL = int(os.getenv('RECIPE_FEED_STATS_INTERVAL', 10))
+
+# read - лента подписок собирается запросом, write - хранится в FeedItem.
+FOLLOWING_FEED_STRATEGY = os.getenv('FOLLOWING_FEED_STRATEGY', 'read')
+FOLLOWING_FEED_BACKFILL = int(os.getenv('FOLLOWING_FEED_BACKFILL', 100))
+
+SIMILAR_RECIPES_INDEX = os.getenv(
+    'SIMILAR_RECIPES_INDEX',
+    os.path.join(BASE_DIR, 'indexes', 'similar_recipes.npz')
+)
+SIMILAR_RECIPES_DELTA_LIMIT = int(
+    os.getenv('SIMILAR_RECIPES_DELTA_LIMIT', 10000)
+)
+
 
 AUTH_USER_MODEL = 'recipes.User'
 
@@ -100,6 +151,11 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.TokenAuthentication',
     ],
 
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 6,
 
@@ -122,3 +178,10 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'collected_static')
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+IMAGE_DERIVATIVE_WORKERS = int(os.getenv('IMAGE_DERIVATIVE_WORKERS', 2))
+
+RECIPE_IMAGE_MAX_SIZE = int(
+    os.getenv('RECIPE_IMAGE_MAX_SIZE', 10 * 1024 * 1024)
+)
+RECIPE_IMAGE_TYPES = ('image/jpeg', 'image/png', 'image/webp', 'image/gif')
@@ -0,0 +1,63 @@
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .models import Favorite, Recipe, ShoppingCart, Subscription, User
+
+# Модель и поле счётчика, модель строк, которые он считает,
+# и внешний ключ этих строк на модель счётчика.
+COUNTERS = (
+    (Recipe, 'favorites_count', Favorite, 'recipe'),
+    (Recipe, 'carts_count', ShoppingCart, 'recipe'),
+    (User, 'recipes_count', Recipe, 'author'),
+    (User, 'subscribers_count', Subscription, 'author'),
+)
+
+
+def change_counter(model, field, pk, delta):
+    rows = model.objects.filter(pk=pk)
+    if delta < 0:
+        # Разошедшийся счётчик не уводим в минус, его поправит recount.
+        rows = rows.filter(**{f'{field}__gte': -delta})
+    return rows.update(**{field: F(field) + delta})
+
+
+def change_counters(source, pk, delta):
+    for model, field, counted, relation in COUNTERS:
+        if counted is source:
+            change_counter(model, field, pk, delta)
+
+
+def actual_count(source, relation):
+    return Coalesce(
+        Subquery(
+            source.objects.filter(
+                **{relation: OuterRef('pk')}
+            ).order_by().values(relation).annotate(
+                total=Count('pk')
+            ).values('total')
+        ),
+        Value(0)
+    )
+
+
+def recount(dry_run=False):
+    drift = {}
+    for model, field, source, relation in COUNTERS:
+        actual = actual_count(source, relation)
+        rows = model.objects.exclude(**{field: actual})
+        drift[f'{model._meta.model_name}.{field}'] = (
+            rows.count() if dry_run else rows.update(**{field: actual})
+        )
+    return drift
+
+
+def recount_for(source, pks):
+    # Массовые вставки и удаления не шлют сигналы, поэтому счётчики
+    # затронутых строк пересчитываем по факту одним UPDATE.
+    if not pks:
+        return
+    for model, field, counted, relation in COUNTERS:
+        if counted is source:
+            model.objects.filter(pk__in=pks).update(
+                **{field: actual_count(counted, relation)}
+            )
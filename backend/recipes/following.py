@@ -0,0 +1,116 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Window
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import RowNumber
+
+from .models import FeedItem, Recipe, Subscription
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+def fan_out_on_write():
+    return settings.FOLLOWING_FEED_STRATEGY == 'write'
+
+
+def limit_recipes_per_author(recipes, limit):
+    ranked = recipes.annotate(
+        author_position=Window(
+            expression=RowNumber(),
+            partition_by=F('author_id'),
+            order_by=(F('pub_date').desc(), F('id').desc()),
+        )
+    ).order_by().values('id', 'author_position')
+    sql, params = ranked.query.sql_with_params()
+    return recipes.filter(pk__in=RawSQL(
+        f'SELECT ranked.id FROM ({sql}) ranked '
+        f'WHERE ranked.author_position <= %s',
+        (*params, limit)
+    ))
+
+
+def backfill(user_id, author_ids):
+    recipes = limit_recipes_per_author(
+        Recipe.objects.filter(author_id__in=author_ids),
+        settings.FOLLOWING_FEED_BACKFILL
+    ).values_list('id', 'pub_date')
+    FeedItem.objects.bulk_create(
+        [FeedItem(user_id=user_id, recipe_id=pk, pub_date=pub_date)
+         for pk, pub_date in recipes],
+        batch_size=BATCH_SIZE,
+        ignore_conflicts=True
+    )
+
+
+def follow(user_id, author_ids):
+    if fan_out_on_write() and author_ids:
+        backfill(user_id, author_ids)
+
+
+def unfollow(user_id, author_ids):
+    if fan_out_on_write() and author_ids:
+        FeedItem.objects.filter(
+            user_id=user_id, recipe__author_id__in=author_ids
+        ).delete()
+
+
+def publish(recipe_id):
+    if not fan_out_on_write():
+        return
+    recipe = Recipe.objects.filter(pk=recipe_id).values(
+        'author_id', 'pub_date'
+    ).first()
+    if recipe is None:
+        return
+    followers = Subscription.objects.filter(
+        author_id=recipe['author_id']
+    ).values_list('user_id', flat=True)
+    FeedItem.objects.bulk_create(
+        (FeedItem(
+            user_id=user_id, recipe_id=recipe_id, pub_date=recipe['pub_date']
+        ) for user_id in followers.iterator()),
+        batch_size=BATCH_SIZE,
+        ignore_conflicts=True
+    )
+
+
+executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix='following-feed'
+)
+
+
+def _run(recipe_id):
+    try:
+        publish(recipe_id)
+    except Exception:
+        logger.exception(
+            'Не удалось разослать рецепт %s по лентам подписчиков', recipe_id
+        )
+    finally:
+        connection.close()
+
+
+def schedule_publish(recipe_id):
+    # У популярного автора подписчиков много: рассылка идёт после
+    # коммита в фоновом потоке и не держит транзакцию создания рецепта.
+    if fan_out_on_write():
+        transaction.on_commit(lambda: executor.submit(_run, recipe_id))
+
+
+def rebuild():
+    FeedItem.objects.all().delete()
+    if not fan_out_on_write():
+        return 0
+    followed = {}
+    for user_id, author_id in Subscription.objects.values_list(
+        'user_id', 'author_id'
+    ).iterator():
+        followed.setdefault(user_id, []).append(author_id)
+    for user_id, author_ids in followed.items():
+        backfill(user_id, author_ids)
+    return FeedItem.objects.count()
@@ -0,0 +1,103 @@
+import logging
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from .versions import bump_version
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVE_SIZES = {
+    'thumbnail': 160,
+    'card': 480,
+    'full': 1280,
+}
+DERIVATIVE_FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 85, 'optimize': True, 'progressive': True}),
+}
+
+executor = ThreadPoolExecutor(
+    max_workers=settings.IMAGE_DERIVATIVE_WORKERS,
+    thread_name_prefix='recipe-images'
+)
+
+
+def derivative_name(name, size, extension):
+    directory, filename = posixpath.split(name)
+    stem = posixpath.splitext(filename)[0]
+    return posixpath.join(
+        directory, 'derivatives', f'{stem}_{size}.{extension}'
+    )
+
+
+def derivative_names(name):
+    return {
+        size: {
+            extension: derivative_name(name, size, extension)
+            for extension in DERIVATIVE_FORMATS
+        } for size in DERIVATIVE_SIZES
+    }
+
+
+def derivatives_ready(name):
+    # Производные пишутся по порядку, последняя служит маркером готовности.
+    return default_storage.exists(derivative_name(
+        name, list(DERIVATIVE_SIZES)[-1], list(DERIVATIVE_FORMATS)[-1]
+    ))
+
+
+def build_derivatives(name):
+    with default_storage.open(name) as source:
+        image = ImageOps.exif_transpose(Image.open(source))
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    for size, edge in DERIVATIVE_SIZES.items():
+        resized = image.copy()
+        resized.thumbnail((edge, edge), Image.LANCZOS)
+        for extension, (image_format, options) in DERIVATIVE_FORMATS.items():
+            frame = resized
+            if image_format == 'JPEG' and frame.mode != 'RGB':
+                frame = frame.convert('RGB')
+            buffer = BytesIO()
+            frame.save(buffer, image_format, **options)
+            target = derivative_name(name, size, extension)
+            default_storage.delete(target)
+            default_storage.save(target, ContentFile(buffer.getvalue()))
+
+
+def delete_derivatives(name):
+    for formats in derivative_names(name).values():
+        for target in formats.values():
+            default_storage.delete(target)
+
+
+def delete_image(name):
+    delete_derivatives(name)
+    default_storage.delete(name)
+
+
+def _run(task, name):
+    try:
+        task(name)
+    except Exception:
+        logger.exception('Не удалось обработать изображение %s', name)
+
+
+def _build_missing(name):
+    if not derivatives_ready(name):
+        build_derivatives(name)
+        # Закэшированные страницы ленты отдают images: null до этой минуты.
+        bump_version('recipes')
+
+
+def schedule_derivatives(name):
+    return executor.submit(_run, _build_missing, name)
+
+
+def schedule_delete_image(name):
+    return executor.submit(_run, delete_image, name)
@@ -0,0 +1,28 @@
+from django.db import connections
+
+from .models import Ingredient, Recipe, User
+
+PREFIX_INDEXES = (
+    (User, 'username', 'user_username_prefix_idx'),
+    (Ingredient, 'name', 'ingredient_name_prefix_idx'),
+    (Recipe, 'name', 'recipe_name_prefix_idx'),
+)
+
+
+def create_prefix_indexes(using='default', **kwargs):
+    # istartswith превращается в UPPER(поле) LIKE 'ПРЕФИКС%'. Индекс по
+    # тому же выражению с collation "C" PostgreSQL берёт для такого LIKE
+    # при любой collation базы. В SQLite такой collation нет, поэтому
+    # индексы не описаны в моделях.
+    database = connections[using]
+    if database.vendor != 'postgresql':
+        return
+    quote = database.ops.quote_name
+    with database.cursor() as cursor:
+        for model, field, name in PREFIX_INDEXES:
+            column = quote(model._meta.get_field(field).column)
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS {name} '
+                f'ON {quote(model._meta.db_table)} '
+                f'((UPPER({column}) COLLATE "C"))'
+            )
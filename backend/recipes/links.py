@@ -0,0 +1,44 @@
+from django.db import connection, transaction
+
+from .counters import recount_for
+from .following import follow, unfollow
+from .models import Favorite, ShoppingCart, Subscription
+
+# Связи пользователя с рецептом или автором и внешний ключ на цель.
+LINK_FIELDS = {
+    Favorite: 'recipe',
+    ShoppingCart: 'recipe',
+    Subscription: 'author',
+}
+
+
+def links_changed(link_model, user_id, target_ids, added):
+    # Единственное место с побочными эффектами связей: его зовут и
+    # сигналы, и массовые операции, которые сигналов не шлют.
+    if not target_ids:
+        return
+    recount_for(link_model, target_ids)
+    if link_model is Subscription:
+        (follow if added else unfollow)(user_id, target_ids)
+
+
+def delete_links(link_model, user_id, target_ids):
+    # Один DELETE ... RETURNING вместо выборки и удаления по объекту:
+    # возвращает цели, связи с которыми действительно удалены.
+    if not target_ids:
+        return []
+    quote = connection.ops.quote_name
+    meta = link_model._meta
+    target = quote(meta.get_field(LINK_FIELDS[link_model]).column)
+    placeholders = ', '.join(['%s'] * len(target_ids))
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {quote(meta.db_table)} '
+                f'WHERE {quote(meta.get_field("user").column)} = %s '
+                f'AND {target} IN ({placeholders}) RETURNING {target}',
+                [user_id, *target_ids]
+            )
+            deleted = [row[0] for row in cursor.fetchall()]
+        links_changed(link_model, user_id, deleted, added=False)
+    return deleted
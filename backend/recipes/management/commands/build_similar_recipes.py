@@ -0,0 +1,20 @@
+import os
+
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from recipes.similarity import rebuild_similar_recipes
+
+
+class Command(BaseCommand):
+    help = (
+        'Собирает MinHash/LSH-индекс похожих рецептов по ингредиентам. '
+        'Дальше индекс обновляется сам при изменении ингредиентов.'
+    )
+
+    def handle(self, *args, **options):
+        total = rebuild_similar_recipes()
+        size = os.path.getsize(settings.SIMILAR_RECIPES_INDEX)
+        self.stdout.write(self.style.SUCCESS(
+            f'Готово! Рецептов: {total}, размер индекса: {size // 1024} КБ'
+        ))
@@ -1,32 +1,213 @@
 import csv
+import io
+import json
+import os
+from itertools import islice
 
-from django.core.management import BaseCommand
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
 
-from foodgram import settings
 from recipes.models import Ingredient, Tag
+from recipes.versions import bump_version
 
-data_path = settings.BASE_DIR
+DATA_PATH = os.path.join(settings.BASE_DIR, 'data')
 
-Model_to_csv = {
-    Ingredient: 'ingredients.csv',
-    Tag: 'tags.csv'
+# Имя набора, модель, натуральный ключ и поля, которые можно обновить.
+DATASETS = (
+    ('ingredients', Ingredient, ('name', 'measurement_unit'), ()),
+    ('tags', Tag, ('slug',), ('name', 'color')),
+)
+
+# Кэши, которые устаревают после загрузки набора.
+DEPENDENT_VERSIONS = {
+    'ingredients': ('ingredients', 'recipes'),
+    'tags': ('tags', 'recipes'),
+}
+
+
+def read_csv(path):
+    with open(path, encoding='utf-8', newline='') as source:
+        yield from csv.DictReader(source)
+
+
+def read_json(path, chunk_size=64 * 1024):
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as source:
+        buffer = source.read(chunk_size).lstrip()
+        if not buffer.startswith('['):
+            raise CommandError(f'{path}: ожидается JSON-массив')
+        buffer = buffer[1:]
+        while True:
+            buffer = buffer.lstrip().lstrip(',').lstrip()
+            if buffer.startswith(']'):
+                return
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    raise CommandError(f'{path}: JSON оборвался')
+                buffer += chunk
+                continue
+            yield item
+            buffer = buffer[end:]
+
+
+READERS = {
+    '.csv': read_csv,
+    '.json': read_json,
 }
 
 
+def batches(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
 class Command(BaseCommand):
-    def handle(self, *args, **kwargs):
-        for model, csv_file in Model_to_csv.items():
-            with open(
-                    f'{data_path}/data/{csv_file}',
-                    'r',
-                    encoding='utf-8',
-            ) as csv_files:
-                reader = csv.DictReader(csv_files)
-                model.objects.bulk_create(
-                    model(**data) for data in reader
+    help = (
+        'Загружает справочники ингредиентов и тэгов из CSV или JSON. '
+        'Повторный запуск обновляет существующие записи, а не дублирует их.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--ingredients',
+            default=os.path.join(DATA_PATH, 'ingredients.csv'),
+            help='Путь к ingredients.csv или ingredients.json.'
+        )
+        parser.add_argument(
+            '--tags',
+            default=os.path.join(DATA_PATH, 'tags.csv'),
+            help='Путь к tags.csv или tags.json.'
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--no-copy',
+            action='store_true',
+            help='Не использовать COPY даже на PostgreSQL.'
+        )
+
+    def handle(self, *args, **options):
+        use_copy = connection.vendor == 'postgresql' and not options['no_copy']
+        for name, model, key_fields, update_fields in DATASETS:
+            path = options[name]
+            reader = READERS.get(os.path.splitext(path)[1].lower())
+            if reader is None:
+                raise CommandError(f'{path}: поддерживаются только CSV и JSON')
+            fields = key_fields + update_fields
+            rows = (
+                {field: row[field].strip() for field in fields}
+                for row in reader(path)
+            )
+            load = self.load_with_copy if use_copy else self.load_with_orm
+            with transaction.atomic():
+                inserted, updated, skipped = load(
+                    name, model, key_fields, update_fields,
+                    batches(rows, options['batch_size'])
+                )
+            for version in DEPENDENT_VERSIONS[name]:
+                bump_version(version)
+            self.stdout.write(self.style.SUCCESS(
+                f'Готово! {name}: добавлено {inserted}, '
+                f'обновлено {updated}, пропущено {skipped}'
+            ))
+
+    def progress(self, name, processed):
+        self.stdout.write(f'{name}: обработано {processed}')
+
+    def load_with_orm(self, name, model, key_fields, update_fields, chunks):
+        inserted = updated = skipped = processed = 0
+        for batch in chunks:
+            existing = {
+                tuple(getattr(obj, field) for field in key_fields): obj
+                for obj in model.objects.filter(**{
+                    f'{key_fields[0]}__in': {
+                        row[key_fields[0]] for row in batch
+                    }
+                })
+            }
+            created, changed = {}, []
+            for row in batch:
+                key = tuple(row[field] for field in key_fields)
+                obj = existing.get(key) or created.get(key)
+                if obj is None:
+                    created[key] = model(**row)
+                elif obj.pk and any(
+                    getattr(obj, field) != row[field]
+                    for field in update_fields
+                ):
+                    for field in update_fields:
+                        setattr(obj, field, row[field])
+                    changed.append(obj)
+                else:
+                    skipped += 1
+            model.objects.bulk_create(created.values())
+            if changed:
+                model.objects.bulk_update(changed, update_fields)
+            inserted += len(created)
+            updated += len(changed)
+            processed += len(batch)
+            self.progress(name, processed)
+        return inserted, updated, skipped
+
+    def load_with_copy(self, name, model, key_fields, update_fields, chunks):
+        quote = connection.ops.quote_name
+        table = quote(model._meta.db_table)
+        columns = {
+            field: quote(model._meta.get_field(field).column)
+            for field in key_fields + update_fields
+        }
+        column_list = ', '.join(columns.values())
+        matches = ' AND '.join(
+            f'target.{columns[field]} = staging.{columns[field]}'
+            for field in key_fields
+        )
+        processed = updated = 0
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE TEMPORARY TABLE staging ON COMMIT DROP AS '
+                f'SELECT {column_list} FROM {table} WITH NO DATA'
+            )
+            for batch in chunks:
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                writer.writerows(
+                    [row[field] for field in columns] for row in batch
+                )
+                buffer.seek(0)
+                cursor.copy_expert(
+                    f'COPY staging ({column_list}) FROM STDIN WITH CSV',
+                    buffer
+                )
+                processed += len(batch)
+                self.progress(name, processed)
+            if update_fields:
+                assignments = ', '.join(
+                    f'{columns[field]} = staging.{columns[field]}'
+                    for field in update_fields
+                )
+                changed = ' OR '.join(
+                    f'target.{columns[field]} IS DISTINCT FROM '
+                    f'staging.{columns[field]}'
+                    for field in update_fields
                 )
-                self.stdout.write(
-                    self.style.SUCCESS(
-                        'Готово! Данные уже в модели'
-                    )
+                cursor.execute(
+                    f'UPDATE {table} AS target SET {assignments} '
+                    f'FROM staging WHERE {matches} AND ({changed})'
                 )
+                updated = cursor.rowcount
+            keys = ', '.join(columns[field] for field in key_fields)
+            cursor.execute(
+                f'INSERT INTO {table} ({column_list}) '
+                f'SELECT DISTINCT ON ({keys}) {column_list} FROM staging '
+                f'WHERE NOT EXISTS (SELECT 1 FROM {table} AS target '
+                f'WHERE {matches})'
+            )
+            inserted = cursor.rowcount
+        return inserted, updated, processed - inserted - updated
@@ -0,0 +1,28 @@
+from django.core.management import BaseCommand
+
+from recipes.images import build_derivatives, derivatives_ready
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = 'Создаёт уменьшенные копии фотографий рецептов, которых ещё нет.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Пересоздать копии даже если они уже есть.'
+        )
+
+    def handle(self, *args, **options):
+        built = 0
+        names = Recipe.objects.exclude(image='').exclude(
+            image__isnull=True
+        ).values_list('image', flat=True).iterator()
+        for name in names:
+            if options['force'] or not derivatives_ready(name):
+                build_derivatives(name)
+                built += 1
+        self.stdout.write(
+            self.style.SUCCESS(f'Готово! Обработано изображений: {built}')
+        )
@@ -0,0 +1,16 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from recipes.following import rebuild
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересобирает ленты подписок в FeedItem. Нужна после включения '
+        'FOLLOWING_FEED_STRATEGY=write; при read просто очищает таблицу.'
+    )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            total = rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Готово! Записей: {total}'))
@@ -0,0 +1,14 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from recipes.search import create_search_index, update_search_index
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает полнотекстовый индекс рецептов.'
+
+    def handle(self, *args, **options):
+        create_search_index()
+        with transaction.atomic():
+            update_search_index()
+        self.stdout.write(self.style.SUCCESS('Готово!'))
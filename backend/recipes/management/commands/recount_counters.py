@@ -0,0 +1,25 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from recipes.counters import recount
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересчитывает счётчики избранного, списков покупок, рецептов '
+        'и подписчиков и исправляет расхождения.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только показать, сколько строк разошлось.'
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            drift = recount(dry_run=options['dry_run'])
+        for counter, rows in drift.items():
+            self.stdout.write(f'{counter}: расхождений {rows}')
+        self.stdout.write(self.style.SUCCESS('Готово!'))
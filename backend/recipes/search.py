@@ -0,0 +1,104 @@
+from django.conf import settings
+from django.contrib.postgres.search import (
+    SearchQuery,
+    SearchRank,
+    SearchVector
+)
+from django.db import DatabaseError, connection, connections
+from django.db.models import F
+from django.db.models.expressions import RawSQL
+
+from .models import Recipe
+
+FTS_TABLE = 'recipes_recipe_fts'
+GIN_INDEX = 'recipe_search_vector_idx'
+
+
+def search_vector():
+    return (
+        SearchVector('name', weight='A', config=settings.SEARCH_CONFIG)
+        + SearchVector('text', weight='B', config=settings.SEARCH_CONFIG)
+    )
+
+
+def create_search_index(using='default', **kwargs):
+    # GIN-индекс и FTS5 зависят от СУБД, поэтому не описаны в модели.
+    database = connections[using]
+    with database.cursor() as cursor:
+        if database.vendor == 'postgresql':
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS {GIN_INDEX} '
+                f'ON {Recipe._meta.db_table} USING gin (search_vector)'
+            )
+        elif database.vendor == 'sqlite':
+            try:
+                cursor.execute(
+                    f'CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} '
+                    f'USING fts5(name, text)'
+                )
+            except DatabaseError:
+                pass
+
+
+def update_search_index(pks=None):
+    recipes = Recipe.objects.all()
+    if pks is not None:
+        recipes = recipes.filter(pk__in=pks)
+    if connection.vendor == 'postgresql':
+        recipes.update(search_vector=search_vector())
+    elif connection.vendor == 'sqlite':
+        delete_from_search_index(pks)
+        sql, params = recipes.values_list(
+            'id', 'name', 'text'
+        ).query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {FTS_TABLE} (rowid, name, text) {sql}',
+                params
+            )
+
+
+def delete_from_search_index(pks=None):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        if pks is None:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+        else:
+            pks = list(pks)
+            cursor.execute(
+                f'DELETE FROM {FTS_TABLE} WHERE rowid IN '
+                f'({", ".join(["%s"] * len(pks))})',
+                pks
+            )
+
+
+def fts_query(value):
+    # Каждое слово ищем как префикс: FTS5 не умеет стемминг.
+    return ' '.join(
+        '"{}"*'.format(word.replace('"', '""')) for word in value.split()
+    )
+
+
+def search_recipes(queryset, value):
+    value = value.strip()
+    if not value:
+        return queryset
+    if connection.vendor == 'postgresql':
+        query = SearchQuery(
+            value, config=settings.SEARCH_CONFIG, search_type='websearch'
+        )
+        return queryset.filter(search_vector=query).annotate(
+            search_rank=SearchRank(F('search_vector'), query)
+        ).order_by('-search_rank', '-pub_date', '-id')
+    match = fts_query(value)
+    table = Recipe._meta.db_table
+    # bm25 возвращает тем меньшее число, чем релевантнее запись.
+    return queryset.filter(pk__in=RawSQL(
+        f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s',
+        [match]
+    )).annotate(search_rank=RawSQL(
+        f'SELECT bm25({FTS_TABLE}, 10.0, 1.0) FROM {FTS_TABLE} '
+        f'WHERE {FTS_TABLE} MATCH %s AND rowid = {table}.id',
+        [match]
+    )).order_by('search_rank', '-pub_date', '-id')
@@ -0,0 +1,192 @@
+from django.db import transaction
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_save
+)
+from django.dispatch import receiver
+
+from .counters import COUNTERS, change_counter
+from .following import schedule_publish
+from .links import LINK_FIELDS, links_changed
+from .images import schedule_delete_image, schedule_derivatives
+from .similarity import schedule_similar_recipes_update
+from .search import delete_from_search_index, update_search_index
+from .models import (
+    Ingredient,
+    IngredientInRecipe,
+    Recipe,
+    Tag,
+    User
+)
+from .versions import bump_version
+
+
+# Версию меняем только после коммита: иначе параллельный запрос
+# прочитает старые строки под новой версией и закэширует их.
+@receiver((post_save, post_delete), sender=Ingredient)
+def ingredients_changed(sender, **kwargs):
+    transaction.on_commit(lambda: bump_version('ingredients'))
+
+
+@receiver((post_save, post_delete), sender=Tag)
+def tags_changed(sender, **kwargs):
+    transaction.on_commit(lambda: bump_version('tags'))
+
+
+@receiver(pre_save, sender=Recipe)
+def recipe_image_replaced(sender, instance, update_fields=None, raw=False,
+                          **kwargs):
+    instance._replaced_image = None
+    if raw or instance._state.adding or (
+        update_fields is not None and 'image' not in update_fields
+    ):
+        return
+    previous = Recipe.objects.filter(pk=instance.pk).values_list(
+        'image', flat=True
+    ).first()
+    if previous and previous != instance.image.name:
+        instance._replaced_image = previous
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_image_saved(sender, instance, **kwargs):
+    if instance.image:
+        name = instance.image.name
+        transaction.on_commit(lambda: schedule_derivatives(name))
+    # Прежний файл удаляем только после коммита: до него транзакция
+    # ещё может откатиться к старой картинке.
+    replaced = getattr(instance, '_replaced_image', None)
+    if replaced:
+        transaction.on_commit(lambda: schedule_delete_image(replaced))
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_image_deleted(sender, instance, **kwargs):
+    if instance.image:
+        name = instance.image.name
+        transaction.on_commit(lambda: schedule_delete_image(name))
+
+
+def invalidate_recipes_feed():
+    transaction.on_commit(lambda: bump_version('recipes'))
+
+
+@receiver((post_save, post_delete), sender=Recipe)
+@receiver((post_save, post_delete), sender=Ingredient)
+@receiver((post_save, post_delete), sender=IngredientInRecipe)
+@receiver((post_save, post_delete), sender=Tag)
+@receiver(post_delete, sender=User)
+def recipes_feed_changed(sender, **kwargs):
+    invalidate_recipes_feed()
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def recipe_tags_changed(sender, action, **kwargs):
+    if action.startswith('post_'):
+        invalidate_recipes_feed()
+
+
+# Поля автора, которые лента показывает в каждом рецепте.
+AUTHOR_FIELDS = ('email', 'username', 'first_name', 'last_name')
+
+
+@receiver(pre_save, sender=User)
+def recipe_author_renamed(sender, instance, update_fields=None, raw=False,
+                          **kwargs):
+    instance._author_renamed = False
+    if raw or instance._state.adding or (
+        update_fields is not None
+        and not set(AUTHOR_FIELDS) & set(update_fields)
+    ):
+        return
+    previous = User.objects.filter(
+        pk=instance.pk, recipes__isnull=False
+    ).values_list(*AUTHOR_FIELDS).first()
+    instance._author_renamed = previous is not None and previous != tuple(
+        getattr(instance, field) for field in AUTHOR_FIELDS
+    )
+
+
+@receiver(post_save, sender=User)
+def recipe_author_changed(sender, instance, **kwargs):
+    if getattr(instance, '_author_renamed', False):
+        invalidate_recipes_feed()
+
+
+def connect_counter(model, field, source, relation):
+    def created(sender, instance, created, raw=False, **kwargs):
+        if created and not raw:
+            change_counter(
+                model, field, getattr(instance, f'{relation}_id'), 1
+            )
+
+    def deleted(sender, instance, **kwargs):
+        change_counter(model, field, getattr(instance, f'{relation}_id'), -1)
+
+    post_save.connect(
+        created, sender=source, weak=False, dispatch_uid=f'{field}-created'
+    )
+    post_delete.connect(
+        deleted, sender=source, weak=False, dispatch_uid=f'{field}-deleted'
+    )
+
+
+for counter in COUNTERS:
+    # Счётчики связей пересчитывает links_changed.
+    if counter[2] not in LINK_FIELDS:
+        connect_counter(*counter)
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_search_changed(sender, instance, update_fields=None, **kwargs):
+    if update_fields and not {'name', 'text'} & set(update_fields):
+        return
+    update_search_index([instance.pk])
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_search_deleted(sender, instance, **kwargs):
+    delete_from_search_index([instance.pk])
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_published(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        schedule_publish(instance.pk)
+
+
+def link_created(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        links_changed(
+            sender,
+            instance.user_id,
+            [getattr(instance, f'{LINK_FIELDS[sender]}_id')],
+            added=True
+        )
+
+
+def link_deleted(sender, instance, **kwargs):
+    links_changed(
+        sender,
+        instance.user_id,
+        [getattr(instance, f'{LINK_FIELDS[sender]}_id')],
+        added=False
+    )
+
+
+for link_model in LINK_FIELDS:
+    post_save.connect(link_created, sender=link_model)
+    post_delete.connect(link_deleted, sender=link_model)
+
+
+@receiver((post_save, post_delete), sender=IngredientInRecipe)
+def recipe_ingredients_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        schedule_similar_recipes_update(instance.recipe_id)
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_similarity_deleted(sender, instance, **kwargs):
+    schedule_similar_recipes_update(instance.pk)
@@ -0,0 +1,301 @@
+import fcntl
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import chain
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import IngredientInRecipe
+
+logger = logging.getLogger(__name__)
+
+# 32 полосы по 3 хеша: рецепт с похожестью по Жаккару s попадает
+# в кандидаты с вероятностью 1 - (1 - s³)³², то есть ~58% при s = 0.3,
+# ~88% при 0.4 и ~99% при 0.5. Точную меру считаем потом.
+SIGNATURE_SIZE = 96
+BANDS = 32
+ROWS = SIGNATURE_SIZE // BANDS
+PRIME = (1 << 31) - 1
+CHUNK_SIZE = 1 << 16
+MASK64 = (1 << 64) - 1
+
+
+def constants(count, seed):
+    # splitmix64: константы не зависят от версии NumPy, и индекс,
+    # собранный одной версией, читается другой.
+    values = []
+    for _ in range(count):
+        seed = (seed + 0x9E3779B97F4A7C15) & MASK64
+        value = seed
+        value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+        value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+        values.append(value ^ (value >> 31))
+    return np.array(values, dtype=np.uint64)
+
+
+HASH_A = constants(SIGNATURE_SIZE, 1) % np.uint64(PRIME - 1) + np.uint64(1)
+HASH_B = constants(SIGNATURE_SIZE, 2) % np.uint64(PRIME)
+BAND_MIX = constants(ROWS, 3) | np.uint64(1)
+
+
+def signatures(indptr, ingredients):
+    count = len(indptr) - 1
+    result = np.empty((count, SIGNATURE_SIZE), dtype=np.uint64)
+    start = 0
+    while start < count:
+        end = np.searchsorted(indptr, indptr[start] + CHUNK_SIZE, 'right')
+        end = min(max(end - 1, start + 1), count)
+        values = ingredients[indptr[start]:indptr[end]].astype(np.uint64)
+        hashes = (values[:, None] * HASH_A + HASH_B) % np.uint64(PRIME)
+        result[start:end] = np.minimum.reduceat(
+            hashes, indptr[start:end] - indptr[start], axis=0
+        )
+        start = end
+    return result
+
+
+def band_keys(minhashes):
+    mixed = minhashes.reshape(len(minhashes), BANDS, ROWS) * BAND_MIX
+    return (
+        mixed.sum(axis=2, dtype=np.uint64) >> np.uint64(32)
+    ).astype(np.uint32)
+
+
+def compress(pairs):
+    ids, starts = np.unique(pairs[:, 0], return_index=True)
+    return ids, np.append(starts, len(pairs)), pairs[:, 1]
+
+
+def gather(indptr, values, rows):
+    # Склеивает срезы values[indptr[row]:indptr[row + 1]] без цикла.
+    lengths = indptr[rows + 1] - indptr[rows]
+    offsets = np.cumsum(lengths) - lengths
+    positions = np.repeat(indptr[rows] - offsets, lengths)
+    return values[positions + np.arange(lengths.sum())], lengths, offsets
+
+
+def load_pairs(pks=None):
+    rows = IngredientInRecipe.objects.order_by('recipe_id', 'ingredient_id')
+    if pks is not None:
+        rows = rows.filter(recipe_id__in=pks)
+    return np.fromiter(
+        chain.from_iterable(rows.values_list(
+            'recipe_id', 'ingredient_id'
+        ).iterator(chunk_size=CHUNK_SIZE)),
+        dtype=np.int64
+    ).reshape(-1, 2)
+
+
+def build(pairs):
+    ids, indptr, ingredients = compress(pairs)
+    keys = band_keys(signatures(indptr, ingredients))
+    band_rows = np.argsort(keys, axis=0, kind='stable')
+    return {
+        'ids': ids,
+        'indptr': indptr,
+        'ingredients': ingredients.astype(np.int32),
+        'band_keys': np.ascontiguousarray(
+            np.take_along_axis(keys, band_rows, axis=0).T
+        ),
+        'band_rows': np.ascontiguousarray(band_rows.T.astype(np.int32)),
+    }
+
+
+def read(path):
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return dict(data)
+
+
+def write(path, arrays):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(f'{path}.tmp', 'wb') as target:
+        np.savez(target, **arrays)
+    os.replace(f'{path}.tmp', path)
+
+
+def delta_path(path):
+    return f'{path}.delta'
+
+
+def drop_delta(path):
+    if os.path.exists(delta_path(path)):
+        os.remove(delta_path(path))
+
+
+@contextmanager
+def locked(path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(f'{path}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def rebuild_similar_recipes():
+    path = settings.SIMILAR_RECIPES_INDEX
+    index = build(load_pairs())
+    with locked(path):
+        write(path, index)
+        drop_delta(path)
+    return len(index['ids'])
+
+
+def update_similar_recipes(pks):
+    # Изменения копятся в маленьком файле поверх основного индекса.
+    # Слияние с ним пересчитывает весь каталог, это работа для
+    # build_similar_recipes, а не для фонового обновления.
+    pks = np.array(sorted(set(pks)), dtype=np.int64)
+    path = settings.SIMILAR_RECIPES_INDEX
+    with locked(path):
+        # Читаем базу под блокировкой: иначе процесс с более старым
+        # снимком ингредиентов может записать дельту последним.
+        pairs = load_pairs(pks.tolist())
+        delta = read(delta_path(path)) or {
+            'pairs': np.empty((0, 2), dtype=np.int64),
+            'removed': np.empty(0, dtype=np.int64),
+        }
+        kept = delta['pairs'][~np.isin(delta['pairs'][:, 0], pks)]
+        pairs = np.concatenate((kept, pairs))
+        delta = {
+            'pairs': pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))],
+            'removed': np.union1d(
+                delta['removed'][~np.isin(delta['removed'], pks)],
+                np.setdiff1d(pks, pairs[:, 0])
+            ),
+        }
+        write(delta_path(path), delta)
+    size = len(delta['pairs']) + len(delta['removed'])
+    if size > settings.SIMILAR_RECIPES_DELTA_LIMIT:
+        logger.warning(
+            'Дельта индекса похожих рецептов выросла до %s строк, '
+            'запустите build_similar_recipes', size
+        )
+
+
+executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix='similar-recipes'
+)
+_pending = threading.local()
+
+
+def _run(pks):
+    try:
+        update_similar_recipes(pks)
+    except Exception:
+        logger.exception('Не удалось обновить индекс похожих рецептов')
+    finally:
+        connection.close()
+
+
+def flush_similar_recipes():
+    pks = getattr(_pending, 'pks', set())
+    _pending.pks = set()
+    if pks:
+        return executor.submit(_run, pks)
+
+
+def schedule_similar_recipes_update(pk):
+    # Все изменения транзакции уходят в индекс одной задачей после
+    # коммита, а файлы пишет фоновый поток, а не запрос.
+    if not hasattr(_pending, 'pks'):
+        _pending.pks = set()
+    _pending.pks.add(pk)
+    transaction.on_commit(flush_similar_recipes)
+
+
+class SimilarRecipesIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = (None, None, None, None)
+
+    def _stamp(self, path):
+        return tuple(
+            os.stat(name).st_mtime_ns if os.path.exists(name) else None
+            for name in (path, delta_path(path))
+        )
+
+    def _load(self, path, stamp):
+        # База большая, а дельта меняется после каждой правки рецепта:
+        # перечитываем базу, только если сменился её собственный файл.
+        loaded, base = self._state[:2]
+        if loaded is None or loaded[:2] != stamp[:2]:
+            base = read(path)
+        delta = read(delta_path(path))
+        stale = None
+        if delta is not None:
+            removed = delta['removed']
+            ids, indptr, ingredients = compress(delta['pairs'])
+            delta = {
+                'ids': ids,
+                'indptr': indptr,
+                'ingredients': ingredients,
+                'keys': band_keys(signatures(indptr, ingredients)),
+            }
+            if base is not None:
+                stale = np.isin(base['ids'], np.concatenate((ids, removed)))
+        self._state = (stamp, base, delta, stale)
+
+    def _current(self):
+        path = settings.SIMILAR_RECIPES_INDEX
+        stamp = (path, *self._stamp(path))
+        if self._state[0] != stamp:
+            with self._lock:
+                if self._state[0] != stamp:
+                    self._load(path, stamp)
+        return self._state[1:]
+
+    def similar(self, pk, ingredient_ids, limit):
+        query = np.unique(np.asarray(ingredient_ids, dtype=np.int64))
+        if not len(query):
+            return []
+        keys = band_keys(signatures(np.array([0, len(query)]), query))[0]
+        base, delta, stale = self._current()
+        found_ids, found_scores = [], []
+        if base is not None:
+            buckets = []
+            for band in range(BANDS):
+                column = base['band_keys'][band]
+                low, high = (
+                    np.searchsorted(column, keys[band], side)
+                    for side in ('left', 'right')
+                )
+                buckets.append(base['band_rows'][band, low:high])
+            rows = np.unique(np.concatenate(buckets))
+            if stale is not None:
+                rows = rows[~stale[rows]]
+            found_ids.append(base['ids'][rows])
+            found_scores.append(self.jaccard(base, rows, query))
+        if delta is not None:
+            rows = np.flatnonzero((delta['keys'] == keys).any(axis=1))
+            found_ids.append(delta['ids'][rows])
+            found_scores.append(self.jaccard(delta, rows, query))
+        if not found_ids:
+            return []
+        ids = np.concatenate(found_ids)
+        scores = np.concatenate(found_scores)
+        matches = (ids != pk) & (scores > 0)
+        ids, scores = ids[matches], scores[matches]
+        order = np.lexsort((ids, -scores))[:limit]
+        return list(zip(ids[order].tolist(), scores[order].tolist()))
+
+    @staticmethod
+    def jaccard(index, rows, query):
+        if not len(rows):
+            return np.empty(0)
+        members, lengths, offsets = gather(
+            index['indptr'], index['ingredients'], rows
+        )
+        common = np.add.reduceat(np.isin(members, query), offsets)
+        return common / (lengths + len(query) - common)
+
+
+similar_recipes = SimilarRecipesIndex()
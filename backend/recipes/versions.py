@@ -0,0 +1,19 @@
+import time
+
+from django.core.cache import cache
+
+
+def _key(name):
+    return f'version:{name}'
+
+
+def get_version(name):
+    return cache.get_or_set(_key(name), time.time_ns(), timeout=None)
+
+
+def bump_version(name):
+    # Версия — время изменения в наносекундах, по ней же строится
+    # Last-Modified у справочников.
+    version = max(time.time_ns(), (cache.get(_key(name)) or 0) + 1)
+    cache.set(_key(name), version, timeout=None)
+    return version